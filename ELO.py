@@ -1,14 +1,118 @@
-import pandas as pd
 import numpy as np
-from tqdm import tqdm
-import matplotlib.pyplot as plt
 import time
-from collections import OrderedDict
-from sklearn.calibration import calibration_curve
-from sklearn.calibration import CalibrationDisplay
+import json
+import itertools
+import numbers
+
+import metrics
+
+# Rating needs nothing but NumPy. pandas (frames), matplotlib (plots) and
+# scipy (recalibration) are imported inside the functions that use them, so
+# `import ELO` stays cheap for batch jobs and prediction services.
+# Stages are timed under elo_stage_seconds once metrics.enable() is called.
+
+SITE_NAMES = np.array(["away", "neutral", "home"])
+
+
+# Games of a model in rating order, kept as compact arrays: teams as int32
+# indices into the model's competitors, sites as int8 signs from the winner's
+# side (+1 home, -1 away, 0 neutral), timestamps as datetime64[ns] and, once
+# rated, each listed winner's pre-game win probability. Team labels, site
+# names and frames are only built when asked for.
+class Games:
+    __slots__ = (
+        "ids",
+        "winner_idx",
+        "loser_idx",
+        "timestamps",
+        "site_signs",
+        "margins",
+        "win_prob",
+    )
+
+    def __init__(
+        self,
+        ids,
+        winner_idx,
+        loser_idx,
+        timestamps=None,
+        site_signs=None,
+        margins=None,
+        win_prob=None,
+    ):
+        self.ids = ids
+        self.winner_idx = winner_idx
+        self.loser_idx = loser_idx
+        self.timestamps = timestamps
+        self.site_signs = site_signs
+        self.margins = margins
+        self.win_prob = win_prob
+
+    def __len__(self):
+        return len(self.ids)
+
+    def columns(self):
+        return [getattr(self, name) for name in Games.__slots__]
+
+    # The games reordered or filtered by an index array
+    def take(self, index):
+        return Games(*(None if a is None else a[index] for a in self.columns()))
+
+    # These games followed by other's. A column only one side has is filled
+    # with NaT/neutral/NaN for the other.
+    def append(self, other):
+        columns = []
+        for mine, theirs in zip(self.columns(), other.columns()):
+            if mine is None and theirs is None:
+                columns.append(None)
+                continue
+            like = theirs if mine is None else mine
+            fill = np.datetime64("NaT") if like.dtype.kind == "M" else 0
+            fill = np.nan if like.dtype.kind == "f" else fill
+            mine = np.full(len(self), fill, like.dtype) if mine is None else mine
+            theirs = np.full(len(other), fill, like.dtype) if theirs is None else theirs
+            columns.append(np.concatenate([mine, theirs]))
+        return Games(*columns)
+
+    # Frame indexed by id with team labels and site names decoded. site and
+    # margin follow win_prob and are only there when the games have them, so
+    # the first columns are always timestamp, winner, loser and win_prob.
+    def to_frame(self, competitors):
+        import pandas as pd
+
+        labels = np.asarray(competitors)
+        with metrics.timer("elo_stage_seconds", stage="games_frame"):
+            columns = {
+                "id": self.ids,
+                "timestamp": self.timestamps,
+                "winner": labels[self.winner_idx],
+                "loser": labels[self.loser_idx],
+                "win_prob": self.win_prob,
+            }
+            if self.site_signs is not None:
+                columns["site"] = SITE_NAMES[self.site_signs + 1]
+            if self.margins is not None:
+                columns["margin"] = self.margins
+            return pd.DataFrame(columns).set_index("id")
 
 
 class ELO:
+    __slots__ = (
+        "k",
+        "elo_init",
+        "elo_diff",
+        "seasonal_mean_reversion",
+        "home_advantage",
+        "margin_of_victory",
+        "ties",
+        "competitors",
+        "games",
+        "engine",
+        "history",
+        "last_timestamp",
+        "last_ids",
+    )
+
     def __init__(
         self,
         winners,
@@ -19,113 +123,481 @@ class ELO:
         elo_init=1500,
         elo_diff=400,
         seasonal_mean_reversion=0,
+        sites=None,
+        home_advantage=0,
+        margins=None,
+        margin_of_victory=False,
+        ties=False,
+        validate=True,
     ):
+        assert margins is not None or not margin_of_victory
         self.k = k
         self.elo_init = elo_init
         self.elo_diff = elo_diff
 
-        winners = list(winners)
-        losers = list(losers)
+        winners = np.asarray(winners)
+        losers = np.asarray(losers)
 
-        ELO.__check_valid_games__(winners, losers, ids, timestamps)
+        # validate=False skips the checks for inputs that are known to be clean
+        with metrics.timer("elo_stage_seconds", stage="validate"):
+            if validate:
+                timestamps = ELO.__check_valid_games__(
+                    winners, losers, ids, timestamps, sites, margins
+                )
+            elif timestamps is not None:
+                timestamps = to_datetime64(timestamps)
         ELO.__check_valid_params__(k, elo_init, elo_diff, seasonal_mean_reversion)
-
-        # Assemble temporary empty dataframe to store ELOs
-        if ids is None:
-            self.ids = range(len(winners))
-        else:
-            self.ids = ids
-        self.winners = winners
-        self.losers = losers
-        self.competitors = sorted(list(set(winners) | set(losers)))
-        self.timestamps = timestamps
         self.seasonal_mean_reversion = seasonal_mean_reversion
-        if self.timestamps is not None:
-            # sort arrays by timestamp
-            self.ids, self.winners, self.losers, self.timestamps = zip(
-                *sorted(
-                    zip(self.ids, self.winners, self.losers, self.timestamps),
-                    key=lambda x: x[3],
-                )
+        # Rating points the home team gets in every expected probability
+        self.home_advantage = home_advantage
+        # Scale updates by the margin of victory (needs margins)
+        self.margin_of_victory = margin_of_victory
+        # With margins given and ties set, games with a margin of 0 are ties
+        self.ties = ties
+        self.engine = None
+        self.history = None
+        self.last_timestamp = None
+        self.last_ids = []
+
+        # Encode both sides together so every team gets one dense index, with
+        # competitors in sorted order. Only the indices are kept per game.
+        with metrics.timer("elo_stage_seconds", stage="encode"):
+            competitors, codes = np.unique(
+                np.concatenate([winners, losers]), return_inverse=True
+            )
+            codes = codes.astype(np.int32)
+            self.competitors = competitors.tolist()
+            self.games = Games(
+                np.arange(len(winners)) if ids is None else np.asarray(ids),
+                codes[: len(winners)],
+                codes[len(winners) :],
+                timestamps,
+                None if sites is None else site_sign(sites).astype(np.int8),
+                None if margins is None else np.asarray(margins, dtype=np.float64),
             )
+            if timestamps is not None and np.any(timestamps[1:] < timestamps[:-1]):
+                # sort games by timestamp, keeping the input order on equal times
+                self.games = self.games.take(np.argsort(timestamps, kind="stable"))
+
+    # Build a model straight from the columns of a games frame, e.g. the wins
+    # of games_2011_to_2023.csv with winner_col="school_id",
+    # loser_col="opponent_school_id" and time_col="date"
+    @classmethod
+    def from_frame(
+        cls,
+        df,
+        winner_col="winner",
+        loser_col="loser",
+        time_col=None,
+        id_col=None,
+        site_col=None,
+        margin_col=None,
+        **kwargs,
+    ):
+        def column(name):
+            return None if name is None else df[name].to_numpy()
+
+        return cls(
+            column(winner_col),
+            column(loser_col),
+            ids=column(id_col),
+            timestamps=column(time_col),
+            sites=column(site_col),
+            margins=column(margin_col),
+            **kwargs,
+        )
+
+    # Columns of the games, decoded from the compact record on access
+    @property
+    def ids(self):
+        return self.games.ids
+
+    @property
+    def winner_idx(self):
+        return self.games.winner_idx
+
+    @property
+    def loser_idx(self):
+        return self.games.loser_idx
+
+    @property
+    def winners(self):
+        return np.asarray(self.competitors)[self.games.winner_idx]
+
+    @property
+    def losers(self):
+        return np.asarray(self.competitors)[self.games.loser_idx]
+
+    @property
+    def timestamps(self):
+        return self.games.timestamps
+
+    # Site of each game from the winner's side (home/away/neutral)
+    @property
+    def sites(self):
+        signs = self.games.site_signs
+        return None if signs is None else SITE_NAMES[signs + 1]
+
+    # Goal differential of each game from the winner's side
+    @property
+    def margins(self):
+        return self.games.margins
+
+    # Pre-game win probability of each listed winner, once fitted
+    @property
+    def win_prob(self):
+        return self.games.win_prob
+
+    # Games and their win probabilities as a frame indexed by id, built on
+    # every access
+    @property
+    def games_df(self):
+        return self.games.to_frame(self.competitors)
 
     # Compute the ELO of every competitor after each match (37s original)
     # 0.04476022720336914s (without dataframe conversion)
     # 0.15063881874084473 (with dataframe conversion)
     def fit_fastest(self):
         start = time.time()
-        elo_dict = OrderedDict(
-            [(competitor, self.elo_init) for competitor in self.competitors]
-        )
-        game_array = np.vstack([self.ids, self.winners, self.losers, self.timestamps]).T
-        elo_array = [np.ones(len(self.competitors)) * self.elo_init]
-        game_probs, winner_prev_elo, loser_prev_elo = [], [], []
-        current_year = self.timestamps[0].year if self.timestamps is not None else None
-        for i, game in enumerate(game_array):
-            game_id, winner, loser, timestamp = game
-            if self.timestamps is not None and timestamp.year != current_year:
-                current_year = timestamp.year
-                mean_elo = np.mean(elo_array[-1])
-                elo_dict = {
-                    team: mean_elo
-                    + (1 - self.seasonal_mean_reversion) * (elo - mean_elo)
-                    for team, elo in elo_dict.items()
-                }
-            winner_elo, loser_elo = elo_dict[winner], elo_dict[loser]
-            winner_new_elo, loser_new_elo, expected_outcome_prob = (
-                ELO.compute_pairwise_elo(
-                    winner_elo, loser_elo, elo_diff=self.elo_diff, k=self.k
-                )
+        self.engine = EloEngine(
+            self.competitors,
+            k=self.k,
+            elo_init=self.elo_init,
+            elo_diff=self.elo_diff,
+            seasonal_mean_reversion=self.seasonal_mean_reversion,
+            home_advantage=self.home_advantage,
+            margin_of_victory=self.margin_of_victory,
+            ties=self.ties,
+        )
+        with metrics.timer("elo_stage_seconds", stage="update_loop"):
+            self.games.win_prob = self.engine.run(
+                self.games.winner_idx,
+                self.games.loser_idx,
+                self.get_seasons(),
+                self.games.site_signs,
+                self.games.margins,
             )
-            game_probs.append(expected_outcome_prob)
-            elo_dict[winner], elo_dict[loser] = winner_new_elo, loser_new_elo
-            elo_array.append(list(elo_dict.values()))
-        self.elo_df = pd.concat(
-            [
-                pd.DataFrame(
-                    np.vstack(
+        with metrics.timer("elo_stage_seconds", stage="history"):
+            self.history = RatingHistory.from_engine(
+                self.engine, ids=self.games.ids, timestamps=self.games.timestamps
+            )
+        self.__mark_last_games__()
+        metrics.count("elo_games_rated_total", len(self.games), call="fit")
+        print("Computed elos in", time.time() - start, "seconds.")
+
+    # Apply new results on top of the fitted ratings. Games played before the
+    # last rated game, or on the same day with an id that was already rated,
+    # are skipped, so the full results file can be passed in again. Without
+    # ids, games on the last rated day are rejected rather than guessed at. A
+    # model that was never fitted is fitted on its own games first. Returns
+    # the rated games with their win probabilities (to_frame(elo.competitors)
+    # turns them into a frame).
+    def update(
+        self,
+        winners,
+        losers,
+        ids=None,
+        timestamps=None,
+        sites=None,
+        margins=None,
+        validate=True,
+    ):
+        if self.engine is None:
+            self.fit_fastest()
+        winners, losers = np.asarray(winners), np.asarray(losers)
+        with metrics.timer("elo_stage_seconds", stage="validate"):
+            if validate:
+                timestamps = ELO.__check_valid_games__(
+                    winners, losers, ids, timestamps, sites, margins
+                )
+            elif timestamps is not None:
+                timestamps = to_datetime64(timestamps)
+        if ids is None:
+            # Generated ids can not tell a game of the last rated day apart
+            # from one that was already rated on it, so those need real ids
+            if timestamps is not None and self.last_timestamp is not None:
+                same_day = np.flatnonzero(timestamps == self.last_timestamp)
+                if len(same_day):
+                    raise InvalidGamesError(
                         [
-                            self.ids,
-                            self.timestamps,
-                            self.winners,
-                            self.losers,
-                            game_probs,
+                            (int(i), "id", "needed for a game on the last rated day")
+                            for i in same_day
                         ]
-                    ).T,
-                    columns=["id", "timestamp", "winner", "loser", "win_prob"],
-                ).set_index("id"),
-                pd.DataFrame(elo_array[1:], columns=self.competitors, index=self.ids),
-            ],
-            axis=1,
+                    )
+            ids = np.arange(len(winners)) + self.engine.total_games
+        ids = np.asarray(ids)
+        keep = np.arange(len(winners))
+        if timestamps is not None:
+            keep = np.argsort(timestamps, kind="stable")
+            if self.last_timestamp is not None:
+                last, stamps = self.last_timestamp, timestamps[keep]
+                keep = keep[
+                    (stamps > last)
+                    | ((stamps == last) & ~np.isin(ids[keep], self.last_ids))
+                ]
+
+        winners, losers = winners[keep].tolist(), losers[keep].tolist()
+        self.engine.add_competitors(winners + losers)
+        start = self.engine.n_games
+        games = Games(
+            ids[keep],
+            self.engine.encode(winners).astype(np.int32),
+            self.engine.encode(losers).astype(np.int32),
+            None if timestamps is None else timestamps[keep],
+            None if sites is None else site_sign(np.asarray(sites)[keep]),
+            None if margins is None else np.asarray(margins, np.float64)[keep],
         )
-        print("Computed elos in", time.time() - start, "seconds.")
+        if games.site_signs is not None:
+            games.site_signs = games.site_signs.astype(np.int8)
+        with metrics.timer("elo_stage_seconds", stage="update_loop"):
+            games.win_prob = self.engine.run(
+                games.winner_idx,
+                games.loser_idx,
+                None if games.timestamps is None else years(games.timestamps),
+                games.site_signs,
+                games.margins,
+            )
+
+        self.competitors = self.engine.competitors
+        self.games = self.games.append(games)
+        with metrics.timer("elo_stage_seconds", stage="history"):
+            self.history.extend(
+                self.engine, start, ids=games.ids, timestamps=games.timestamps
+            )
+        self.__mark_last_games__()
+        metrics.count("elo_games_rated_total", len(games), call="update")
+        return games
 
-    # Show a calibration curve of the ELO output probabilities after fitting
-    def show_calibration(self, start_year=2018, A=5, B=0.2):
-        d = self.elo_df.loc[self.elo_df.timestamp > str(start_year)]
-        win_sample = d.sample(frac=0.5)
-        lose_sample = d.drop(win_sample.index)
-        p_true = [1] * len(win_sample) + [0] * len(lose_sample)
-        p_pred = win_sample.win_prob.tolist() + (1 - lose_sample.win_prob).tolist()
-        p_pred = np.array(p_pred)
+    # Write the current rating state to a JSON checkpoint
+    def save_checkpoint(self, path):
+        state = {
+            **self.engine.state(),
+            "last_timestamp": (
+                None if self.last_timestamp is None else str(self.last_timestamp)
+            ),
+            "last_ids": [to_builtin(game_id) for game_id in self.last_ids],
+        }
+        with open(path, "w") as f:
+            json.dump(state, f)
 
-        def sigmoid(x, A, B):
-            return 1 / (1 + np.exp(A * x + B))
+    # Resume from a checkpoint written by save_checkpoint. The returned model
+    # holds no games until update() is called.
+    @classmethod
+    def from_checkpoint(cls, path):
+        with open(path) as f:
+            state = json.load(f)
+        elo = cls.__new__(cls)
+        elo.engine = EloEngine.from_state(state)
+        elo.k = elo.engine.k
+        elo.elo_init = elo.engine.elo_init
+        elo.elo_diff = elo.engine.elo_diff
+        elo.seasonal_mean_reversion = elo.engine.seasonal_mean_reversion
+        elo.home_advantage = elo.engine.home_advantage
+        elo.margin_of_victory = elo.engine.margin_of_victory
+        elo.ties = elo.engine.ties
+        elo.competitors = elo.engine.competitors
+        elo.last_timestamp = (
+            None
+            if state["last_timestamp"] is None
+            else as_datetime64(state["last_timestamp"])
+        )
+        elo.last_ids = state["last_ids"]
+        elo.games = Games(
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.int32),
+            (
+                None
+                if elo.last_timestamp is None
+                else np.empty(0, dtype="datetime64[ns]")
+            ),
+            win_prob=np.empty(0),
+        )
+        elo.history = RatingHistory.from_engine(
+            elo.engine, ids=elo.games.ids, timestamps=elo.games.timestamps
+        )
+        return elo
+
+    # Remember the date of the last rated game and the ids played on it
+    def __mark_last_games__(self):
+        timestamps = self.games.timestamps
+        if timestamps is None or len(timestamps) == 0:
+            return
+        last_timestamp = timestamps[-1]
+        first = np.searchsorted(timestamps, last_timestamp, side="left")
+        last_ids = self.games.ids[first:].tolist()
+        if last_timestamp == self.last_timestamp:
+            last_ids = list(dict.fromkeys(self.last_ids + last_ids))
+        self.last_timestamp, self.last_ids = last_timestamp, last_ids
 
-        def invsigmoid(x, A, B=1 / 2):
-            return -(1 / A) * np.log((1 + B) / (x + B / 2) - 1) + 1 / 2
+    # Current ratings of any teams, with unseen teams at the initial rating
+    def current_ratings(self, teams):
+        team_index = self.engine.team_index
+        teams = np.asarray(teams).tolist()
+        idx = np.fromiter(
+            (team_index.get(team, -1) for team in teams),
+            dtype=np.int64,
+            count=len(teams),
+        )
+        return np.where(idx >= 0, self.engine.ratings[idx], float(self.elo_init))
+
+    # Probability that each home team beats its away opponent under the current
+    # ratings. site is relative to the first team: "home", "away" or "neutral".
+    def predict(self, home, away, site="home"):
+        home_elo = self.current_ratings(home) + self.home_advantage * site_sign(site)
+        return ELO.compute_expected_outcome_prob(
+            home_elo, self.current_ratings(away), elo_diff=self.elo_diff
+        )
 
-        prob_true, prob_pred = calibration_curve(
-            p_true, invsigmoid(p_pred, A, B), n_bins=20, strategy="uniform"
+    # Fit every (k, elo_diff, seasonal_mean_reversion, home_advantage,
+    # margin_of_victory) configuration in one sorted pass over the games and
+    # score each on games played since a date. Parameters are broadcast against
+    # each other, or crossed when grid=True. margin_of_victory needs margins.
+    def fit_sweep(
+        self,
+        k,
+        elo_diff=400,
+        seasonal_mean_reversion=0.0,
+        home_advantage=0.0,
+        margin_of_victory=False,
+        since=None,
+        grid=False,
+    ):
+        import pandas as pd
+
+        params = [
+            np.atleast_1d(k),
+            np.atleast_1d(elo_diff),
+            np.atleast_1d(seasonal_mean_reversion),
+            np.atleast_1d(home_advantage),
+            np.atleast_1d(margin_of_victory),
+        ]
+        if grid:
+            params = [p.ravel() for p in np.meshgrid(*params, indexing="ij")]
+        k, elo_diff, smr, home_advantage, mov = (
+            p.astype(np.float64) for p in np.broadcast_arrays(*params)
+        )
+        assert self.margins is not None or not np.any(mov)
+        assert np.all(k > 0) and np.all(elo_diff > 0) and np.all(smr <= 1)
+
+        ratings = np.full(
+            (len(self.competitors), len(k)), self.elo_init, dtype=np.float64
+        )
+        with metrics.timer("elo_stage_seconds", stage="sweep"):
+            win_prob, _, _, _ = update_ratings(
+                ratings,
+                self.games.winner_idx,
+                self.games.loser_idx,
+                find_season_starts(self.get_seasons()),
+                k=k,
+                elo_diff=elo_diff,
+                seasonal_mean_reversion=smr,
+                site_signs=self.games.site_signs,
+                home_advantage=home_advantage,
+                margins=self.games.margins,
+                mov=mov,
+                ties=self.ties,
+                record_ratings=False,
+            )
+
+        outcomes = self.get_outcomes()
+        if since is not None:
+            start = np.searchsorted(self.timestamps, as_datetime64(since))
+            win_prob, outcomes = win_prob[start:], outcomes[start:]
+        return pd.DataFrame(
+            {
+                "k": k,
+                "elo_diff": elo_diff,
+                "seasonal_mean_reversion": smr,
+                "home_advantage": home_advantage,
+                "margin_of_victory": mov.astype(bool),
+                **score_win_probs(win_prob, outcomes),
+                "ece": calibration_scores(win_prob, outcomes)["ece"],
+            }
+        )
+
+    # Log-loss, Brier and accuracy gain of margin-of-victory updates over the
+    # base model for each parameter configuration, from one batched pass
+    def compare_margin_of_victory(self, since=None, **params):
+        sweep = self.fit_sweep(
+            margin_of_victory=[False, True], since=since, grid=True, **params
+        )
+        base, mov = sweep.iloc[0::2].reset_index(drop=True), sweep.iloc[1::2]
+        mov = mov.reset_index(drop=True)
+        keys = ["k", "elo_diff", "seasonal_mean_reversion", "home_advantage"]
+        return base[keys].assign(
+            log_loss_gain=base.log_loss - mov.log_loss,
+            brier_gain=base.brier - mov.brier,
+            accuracy_gain=mov.accuracy - base.accuracy,
         )
-        # prob_true, prob_pred = calibration_curve(p_true, p_pred, n_bins=20, strategy='uniform')
+
+    # Actual score of each listed winner: 0.5 for rated ties, otherwise 1
+    def get_outcomes(self):
+        if not self.ties or self.margins is None:
+            return np.ones(len(self.games))
+        return np.where(self.margins == 0, 0.5, 1.0)
+
+    # Season (calendar year) of every game, or None without timestamps
+    def get_seasons(self):
+        if self.timestamps is None:
+            return None
+        return years(self.timestamps)
+
+    # Fitted win probabilities and outcomes of the games played since a date
+    def __scored_games__(self, since=None):
+        win_prob = self.win_prob
+        outcomes = self.get_outcomes()
+        if since is not None:
+            start = np.searchsorted(self.timestamps, as_datetime64(since))
+            win_prob, outcomes = win_prob[start:], outcomes[start:]
+        return win_prob, outcomes
+
+    # Reliability bins, ECE, Brier score and log-loss of the fitted win
+    # probabilities on games since a date, recalibrated with the inverse
+    # sigmoid when A and B are given. Nothing is sampled or plotted.
+    def calibration(self, since=None, n_bins=20, A=None, B=None):
+        win_prob, outcomes = self.__scored_games__(since)
+        if A is not None:
+            win_prob = ELO.invsigmoid(win_prob, A, B)
+        return calibration_scores(win_prob, outcomes, n_bins=n_bins)
+
+    # Inverse sigmoid A and B with the lowest log-loss on games since a date
+    def fit_calibration(self, since=None, A=5, B=0.2):
+        win_prob, outcomes = self.__scored_games__(since)
+        return fit_recalibration(win_prob, outcomes, A=A, B=B)
+
+    # Plot the calibration curve of the fitted probabilities since start_year
+    # after the inverse sigmoid recalibration (none with A=None), and return
+    # the scores it shows
+    def show_calibration(self, start_year=2018, A=5, B=0.2, n_bins=20):
+        import matplotlib.pyplot as plt
+
+        scores = self.calibration(since=start_year, n_bins=n_bins, A=A, B=B)
+        filled = scores["count"] > 0
         plt.figure(dpi=300)
-        CalibrationDisplay(prob_true, prob_pred, p_pred).plot()
+        plt.plot([0, 1], [0, 1], "k:", label="Perfectly calibrated")
+        plt.plot(
+            scores["mean_pred"][filled], scores["frac_true"][filled], "s-", label="ELO"
+        )
+        plt.xlabel("Mean predicted probability")
+        plt.ylabel("Fraction of wins")
+        plt.legend()
         plt.suptitle("Calibration Curve with Inverse Sigmoid")
         plt.title(
-            f"A={A}, B={B}, start_year={start_year}, k={self.k}, elo_init={self.elo_init}, elo_diff={self.elo_diff}, smr={self.seasonal_mean_reversion}"
+            f"A={A}, B={B}, start_year={start_year}, k={self.k}, elo_init={self.elo_init}, elo_diff={self.elo_diff}, smr={self.seasonal_mean_reversion}, ECE={scores['ece']:.4f}"
         )
         plt.grid()
+        return scores
+
+    # Rating points that make a team with an equal rating win at home_win_pct
+    @staticmethod
+    def compute_home_elo_advantage(home_win_pct, elo_diff=400):
+        return -elo_diff * np.log10(1 / home_win_pct - 1)
+
+    # Recalibrate win probabilities with an inverse sigmoid
+    @staticmethod
+    def invsigmoid(x, A, B=1 / 2):
+        return -(1 / A) * np.log((1 + B) / (x + B / 2) - 1) + 1 / 2
 
     @staticmethod
     def compute_pairwise_elo(winner_elo, loser_elo, elo_diff, k):
@@ -144,42 +616,749 @@ class ELO:
 
     @staticmethod
     def __check_valid_params__(k, elo_init, elo_diff, seasonal_mean_reversion):
-        assert isinstance(k, int) and k > 0
-        assert isinstance(elo_init, int) and elo_init > 0
-        assert isinstance(elo_diff, int) and elo_diff > 0
+        assert isinstance(k, numbers.Integral) and k > 0
+        assert isinstance(elo_init, numbers.Integral) and elo_init > 0
+        assert isinstance(elo_diff, numbers.Integral) and elo_diff > 0
         assert (
-            isinstance(seasonal_mean_reversion, float) and seasonal_mean_reversion <= 1
+            isinstance(seasonal_mean_reversion, numbers.Real)
+            and seasonal_mean_reversion <= 1
         )
 
+    # Check every game at once and raise a single InvalidGamesError listing
+    # each bad row. Returns the timestamps parsed to datetime64[ns] (or None)
+    # so they are only parsed here.
     @staticmethod
-    def __check_valid_games__(winners, losers, ids, timestamps):
-        # assert proper data types
-        assert pd.api.types.is_list_like(winners)
-        assert pd.api.types.is_list_like(losers)
-        assert ids is None or pd.api.types.is_list_like(ids)
-        assert timestamps is None or pd.api.types.is_list_like(timestamps)
-
-        # check that winners, losers, ids, and timestamps have the same length
-        assert len(winners) == len(losers)
-        assert ids is None or len(ids) == len(winners)
-        assert timestamps is None or len(timestamps) == len(winners)
+    def __check_valid_games__(
+        winners, losers, ids, timestamps, sites=None, margins=None
+    ):
+        columns = {
+            "winner": winners,
+            "loser": losers,
+            "id": ids,
+            "timestamp": timestamps,
+            "site": sites,
+            "margin": margins,
+        }
+        columns = {name: c for name, c in columns.items() if c is not None}
 
-        # check that all ids are unique
-        assert ids is None or len(set(ids)) == len(ids)
+        # check proper data types and that every column has the same length
+        problems = [
+            (None, name, "not list-like")
+            for name, column in columns.items()
+            if not hasattr(column, "__len__") or isinstance(column, (str, bytes))
+        ]
+        if not problems:
+            problems = [
+                (None, name, f"length {len(column)} != {len(winners)}")
+                for name, column in columns.items()
+                if len(column) != len(winners)
+            ]
+        if problems:
+            raise InvalidGamesError(problems)
 
+        def flag(mask, name, problem):
+            problems.extend((int(i), name, problem) for i in np.flatnonzero(mask))
+
+        winners, losers = np.asarray(winners), np.asarray(losers)
+        flag(is_missing(winners), "winner", "missing team")
+        flag(is_missing(losers), "loser", "missing team")
         # check that no teams play against themselves
-        for i in range(len(winners)):
-            assert winners[i] != losers[i]
+        flag(winners == losers, "loser", "same as winner")
+
+        # check that all ids are unique
+        if ids is not None:
+            ids = np.asarray(ids)
+            try:
+                _, inverse, counts = np.unique(
+                    ids, return_inverse=True, return_counts=True
+                )
+            except TypeError:
+                # ids of types that do not sort against each other
+                import pandas as pd
+
+                inverse, _ = pd.factorize(ids, use_na_sentinel=False)
+                counts = np.bincount(inverse)
+            flag(counts[inverse] > 1, "id", "duplicate id")
 
-        # check that the timestamps are valid
+        # check that the timestamps are valid, parsing them all in one call
+        parsed = None
         if timestamps is not None:
-            for timestamp in timestamps:
-                try:
-                    pd.to_datetime(timestamp)
-                except ValueError:
-                    raise ValueError("Invalid timestamp: {}".format(timestamp))
+            parsed = to_datetime64(timestamps)
+            flag(np.isnat(parsed), "timestamp", "invalid timestamp")
 
-    def show_elos(self, since=None):
-        if since is not None:
-            return self.elo_df.loc[self.elo_df.timestamp >= str(since)]
-        return self.elo_df
+        # check that sites are home, away or neutral
+        if sites is not None:
+            flag(
+                ~np.isin(np.asarray(sites), ["home", "away", "neutral"]),
+                "site",
+                "not home, away or neutral",
+            )
+
+        # check that margins are non-negative goal differentials
+        if margins is not None:
+            flag(~(to_float64(margins) >= 0), "margin", "not a non-negative number")
+
+        if problems:
+            raise InvalidGamesError(problems)
+        return parsed
+
+    # Dense games x competitors frame of every rating, built on every access
+    @property
+    def elo_df(self):
+        return self.show_elos()
+
+    # Ratings after each game since a date, optionally for a subset of teams.
+    # Only the requested rows and columns are materialized.
+    def show_elos(self, since=None, teams=None):
+        import pandas as pd
+
+        start = 0 if since is None else self.history.position_as_of(since, side="left")
+        with metrics.timer("elo_stage_seconds", stage="elo_frame"):
+            ratings = self.history.to_frame(teams=teams, start=start)
+            return pd.concat([self.games_df.iloc[start:], ratings], axis=1)
+
+
+# Timestamps as a datetime64[ns] array. NumPy parses ISO dates and datetime
+# objects; anything else (e.g. "03/02/2012") goes through pandas, with values
+# that can not be parsed becoming NaT.
+def to_datetime64(values):
+    try:
+        return np.asarray(values, dtype="datetime64[ns]")
+    except (ValueError, TypeError):
+        import pandas as pd
+
+        parsed = pd.to_datetime(
+            pd.Series(np.asarray(values, dtype=object)), errors="coerce"
+        )
+        return parsed.to_numpy(dtype="datetime64[ns]")
+
+
+# A single date (2018, "2018-03-01", a datetime) as datetime64[ns]
+def as_datetime64(date):
+    if isinstance(date, numbers.Integral):
+        date = str(date)
+    return to_datetime64([date])[0]
+
+
+# Calendar year of each datetime64 timestamp
+def years(timestamps):
+    return timestamps.astype("datetime64[Y]").astype(np.int64) + 1970
+
+
+# Missing entries (None, NaN, NaT) of an array of any dtype
+def is_missing(values):
+    values = np.asarray(values)
+    if values.dtype.kind in "fc":
+        return np.isnan(values)
+    if values.dtype.kind in "mM":
+        return np.isnat(values)
+    if values.dtype.kind == "O":
+        # NaN and NaT are the values not equal to themselves
+        return np.equal(values, None) | np.not_equal(values, values)
+    return np.zeros(len(values), dtype=bool)
+
+
+# Values as float64, with entries that are not numbers as NaN
+def to_float64(values):
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (ValueError, TypeError):
+        floats = np.full(len(values), np.nan)
+        for i, value in enumerate(np.asarray(values, dtype=object).tolist()):
+            try:
+                floats[i] = float(value)
+            except (ValueError, TypeError):
+                pass
+        return floats
+
+
+# Raised with every invalid game row at once. problems is a list of
+# (row, column, problem) tuples, with row None for whole-column problems.
+class InvalidGamesError(ValueError):
+    def __init__(self, problems):
+        self.problems = problems
+        shown = "\n".join(
+            f"  row {row}, {column}: {problem}"
+            for row, column, problem in problems[:20]
+        )
+        more = f"\n  ... and {len(problems) - 20} more" if len(problems) > 20 else ""
+        super().__init__(f"{len(problems)} invalid game entries:\n{shown}{more}")
+
+    # Problems as a frame with one row per issue
+    def to_frame(self):
+        import pandas as pd
+
+        return pd.DataFrame(self.problems, columns=["row", "column", "problem"])
+
+
+# Rating engine that maps competitors to dense integer indices once and keeps
+# every rating in a preallocated float64 array. Each game only touches the two
+# ratings involved, and only those two post-game ratings are written to the
+# delta log, so the cost per game does not grow with the number of teams.
+class EloEngine:
+    __slots__ = (
+        "competitors",
+        "team_index",
+        "k",
+        "elo_init",
+        "elo_diff",
+        "seasonal_mean_reversion",
+        "home_advantage",
+        "margin_of_victory",
+        "ties",
+        "ratings",
+        "initial_ratings",
+        "current_season",
+        "game_offset",
+        "n_games",
+        "winner_idx",
+        "loser_idx",
+        "winner_elo",
+        "loser_elo",
+        "win_prob",
+        "season_starts",
+        "season_snapshots",
+    )
+
+    def __init__(
+        self,
+        competitors,
+        k=20,
+        elo_init=1500,
+        elo_diff=400,
+        seasonal_mean_reversion=0,
+        home_advantage=0,
+        margin_of_victory=False,
+        ties=False,
+    ):
+        self.competitors = list(competitors)
+        self.team_index = {team: i for i, team in enumerate(self.competitors)}
+        self.k = k
+        self.elo_init = elo_init
+        self.elo_diff = elo_diff
+        self.seasonal_mean_reversion = seasonal_mean_reversion
+        self.home_advantage = home_advantage
+        self.margin_of_victory = margin_of_victory
+        self.ties = ties
+        self.ratings = np.full(len(self.competitors), elo_init, dtype=np.float64)
+        self.initial_ratings = self.ratings.copy()
+        self.current_season = None
+        # Games applied before the delta log starts (e.g. before a checkpoint)
+        # and games held in the log
+        self.game_offset = 0
+        self.n_games = 0
+
+        # Delta log: one entry per game holding the two changed ratings
+        self.winner_idx = np.empty(0, dtype=np.int32)
+        self.loser_idx = np.empty(0, dtype=np.int32)
+        self.winner_elo = np.empty(0, dtype=np.float64)
+        self.loser_elo = np.empty(0, dtype=np.float64)
+        self.win_prob = np.empty(0, dtype=np.float64)
+
+        # Season resets touch every team, so keep a full snapshot of the
+        # ratings right after each reset along with the game it precedes
+        self.season_starts = np.empty(0, dtype=np.int64)
+        self.season_snapshots = np.empty((0, len(self.competitors)), dtype=np.float64)
+
+    # Map team labels to their dense integer indices
+    def encode(self, teams):
+        team_index = self.team_index
+        return np.fromiter(
+            (team_index[team] for team in teams), dtype=np.int64, count=len(teams)
+        )
+
+    # Register competitors that have not been seen yet at the initial rating
+    def add_competitors(self, competitors):
+        new = [
+            team for team in dict.fromkeys(competitors) if team not in self.team_index
+        ]
+        for team in new:
+            self.team_index[team] = len(self.competitors)
+            self.competitors.append(team)
+        pad = np.full(len(new), self.elo_init, dtype=np.float64)
+        self.ratings = np.concatenate([self.ratings, pad])
+        self.initial_ratings = np.concatenate([self.initial_ratings, pad])
+        self.season_snapshots = np.hstack(
+            [self.season_snapshots, np.tile(pad, (len(self.season_snapshots), 1))]
+        )
+        return new
+
+    # Total number of games the current ratings reflect
+    @property
+    def total_games(self):
+        return self.game_offset + self.n_games
+
+    # Everything needed to resume rating from the current state
+    def state(self):
+        return {
+            "competitors": [to_builtin(team) for team in self.competitors],
+            "ratings": self.ratings.tolist(),
+            "current_season": to_builtin(self.current_season),
+            "n_games": self.total_games,
+            "k": self.k,
+            "elo_init": self.elo_init,
+            "elo_diff": self.elo_diff,
+            "seasonal_mean_reversion": self.seasonal_mean_reversion,
+            "home_advantage": self.home_advantage,
+            "margin_of_victory": self.margin_of_victory,
+            "ties": self.ties,
+        }
+
+    # Engine resuming from a saved state, with an empty delta log
+    @classmethod
+    def from_state(cls, state):
+        engine = cls(
+            state["competitors"],
+            k=state["k"],
+            elo_init=state["elo_init"],
+            elo_diff=state["elo_diff"],
+            seasonal_mean_reversion=state["seasonal_mean_reversion"],
+            home_advantage=state.get("home_advantage", 0),
+            margin_of_victory=state.get("margin_of_victory", False),
+            ties=state.get("ties", False),
+        )
+        engine.ratings = np.array(state["ratings"], dtype=np.float64)
+        engine.initial_ratings = engine.ratings.copy()
+        engine.current_season = state["current_season"]
+        engine.game_offset = state["n_games"]
+        return engine
+
+    # Apply a sequence of encoded games in order and return the pre-game win
+    # probability of each winner. site_signs gives each winner's site as +1
+    # (home), -1 (away) or 0 (neutral). margins scale the updates when
+    # margin_of_victory is set and mark ties when ties is set.
+    def run(self, winner_idx, loser_idx, seasons=None, site_signs=None, margins=None):
+        winner_idx = np.asarray(winner_idx, dtype=np.int32)
+        loser_idx = np.asarray(loser_idx, dtype=np.int32)
+        n = len(winner_idx)
+        season_starts = find_season_starts(seasons, self.current_season)
+        win_prob, winner_elo, loser_elo, snapshots = update_ratings(
+            self.ratings,
+            winner_idx,
+            loser_idx,
+            season_starts,
+            k=self.k,
+            elo_diff=self.elo_diff,
+            seasonal_mean_reversion=self.seasonal_mean_reversion,
+            site_signs=site_signs,
+            home_advantage=self.home_advantage,
+            margins=margins,
+            mov=float(self.margin_of_victory),
+            ties=self.ties,
+        )
+
+        if seasons is not None and n > 0:
+            self.current_season = seasons[-1]
+        # The first run keeps its arrays as they are (shared with the caller's
+        # games) rather than copying them onto the empty log
+        log = {
+            "winner_idx": winner_idx,
+            "loser_idx": loser_idx,
+            "winner_elo": winner_elo,
+            "loser_elo": loser_elo,
+            "win_prob": win_prob,
+            "season_starts": season_starts + self.n_games,
+            "season_snapshots": snapshots,
+        }
+        for name, values in log.items():
+            if self.n_games > 0:
+                values = np.concatenate([getattr(self, name), values])
+            setattr(self, name, values)
+        self.n_games += n
+        return win_prob
+
+
+# Convert NumPy scalars to plain Python values for JSON
+def to_builtin(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+# +1 for games at the first team's home, -1 away and 0 on a neutral site
+def site_sign(site):
+    site = np.asarray(site)
+    return np.where(site == "home", 1, np.where(site == "away", -1, 0))
+
+
+# Positions of the games that open a new season, given the season of each game
+# and the season the ratings were last updated in
+def find_season_starts(seasons, current_season=None):
+    if seasons is None or len(seasons) == 0:
+        return np.empty(0, dtype=np.int64)
+    seasons = np.asarray(seasons)
+    previous = np.empty_like(seasons)
+    previous[0] = seasons[0] if current_season is None else current_season
+    previous[1:] = seasons[:-1]
+    return np.flatnonzero(seasons != previous)
+
+
+# Core update loop shared by single fits and parameter sweeps. ratings is either
+# a (teams,) vector or a (teams, configs) matrix updated in place, in which case
+# k, elo_diff, seasonal_mean_reversion and home_advantage may be (configs,)
+# arrays and every game is a single NumPy operation across all configurations.
+# The winner's rating is shifted by home_advantage times its site sign.
+#
+# With margins (winner's goals minus loser's) the update is scaled by the
+# margin-of-victory multiplier ln(margin + 1) * 2.2 / (0.001 * elo gap + 2.2),
+# where the elo gap term corrects for favourites winning by more. mov blends
+# between the plain update (0) and the margin-aware one (1), per configuration.
+# Games with a margin of 0 count as ties (actual score 0.5) when ties is set,
+# scaled without the gap correction, and as one goal wins otherwise.
+def update_ratings(
+    ratings,
+    winner_idx,
+    loser_idx,
+    season_starts,
+    k,
+    elo_diff,
+    seasonal_mean_reversion,
+    site_signs=None,
+    home_advantage=0,
+    margins=None,
+    mov=1,
+    ties=False,
+    record_ratings=True,
+):
+    n = len(winner_idx)
+    configs = ratings.shape[1:]
+    win_prob = np.empty((n, *configs), dtype=np.float64)
+    winner_elo = np.empty((n, *configs), dtype=np.float64) if record_ratings else None
+    loser_elo = np.empty((n, *configs), dtype=np.float64) if record_ratings else None
+    snapshots = np.empty((len(season_starts), *ratings.shape), dtype=np.float64)
+
+    resets = {start: j for j, start in enumerate(np.asarray(season_starts).tolist())}
+    signs = (
+        itertools.repeat(0) if site_signs is None else np.asarray(site_signs).tolist()
+    )
+    mov_logs, outcomes = itertools.repeat(None), itertools.repeat(1.0)
+    if margins is not None:
+        margins = np.abs(np.asarray(margins, dtype=np.float64))
+        mov_logs = np.log(np.maximum(margins, 1) + 1).tolist()
+        if ties:
+            outcomes = np.where(margins == 0, 0.5, 1.0).tolist()
+    games = zip(winner_idx.tolist(), loser_idx.tolist(), signs, mov_logs, outcomes)
+    for i, (w, l, sign, mov_log, outcome) in enumerate(games):
+        if i in resets:
+            mean_elo = ratings.mean(axis=0)
+            ratings -= seasonal_mean_reversion * (ratings - mean_elo)
+            snapshots[resets[i]] = ratings
+        edge = sign * home_advantage
+        gap = ratings[w] + edge - ratings[l]
+        p = 1 / (1 + 10 ** (-gap / elo_diff))
+        delta = k * (outcome - p)
+        if mov_log is not None:
+            # A tie has no favourite that won big, and correcting by the gap
+            # of whichever side is listed first would make it asymmetric
+            correction = 2.2 / (gap * 0.001 + 2.2) if outcome == 1 else 1
+            delta = delta * (1 - mov + mov * mov_log * correction)
+        ratings[w] += delta
+        ratings[l] -= delta
+        win_prob[i] = p
+        if record_ratings:
+            winner_elo[i], loser_elo[i] = ratings[w], ratings[l]
+    return win_prob, winner_elo, loser_elo, snapshots
+
+
+# Accuracy, log-loss and Brier score of the pre-game win probabilities of the
+# listed winners, per column when scoring several configurations at once.
+# outcomes holds the listed winner's actual score (1, or 0.5 for a tie); ties
+# count towards log-loss and Brier score but not accuracy.
+def score_win_probs(win_prob, outcomes=None, eps=1e-15):
+    win_prob = np.clip(win_prob, eps, 1 - eps)
+    if outcomes is None:
+        outcomes = np.ones(len(win_prob))
+    outcomes = np.asarray(outcomes, dtype=np.float64).reshape(
+        (-1,) + (1,) * (win_prob.ndim - 1)
+    )
+    decided = outcomes == 1
+    return {
+        "accuracy": np.sum((win_prob > 0.5) & decided, axis=0) / max(decided.sum(), 1),
+        "log_loss": -np.mean(
+            outcomes * np.log(win_prob) + (1 - outcomes) * np.log(1 - win_prob), axis=0
+        ),
+        "brier": np.mean((outcomes - win_prob) ** 2, axis=0),
+    }
+
+
+# Reliability of win probabilities in n_bins equal width bins, with the
+# expected calibration error (the count weighted gap between mean predicted
+# probability and fraction of wins per bin), Brier score and log-loss, per
+# column when scoring several configurations at once. Every game is counted
+# from both sides, (p, outcome) for the listed winner and (1 - p, 1 - outcome)
+# for the loser, so no random half of the games has to be picked.
+def calibration_scores(win_prob, outcomes=None, n_bins=20, eps=1e-15):
+    win_prob = np.clip(np.asarray(win_prob, dtype=np.float64), 0, 1)
+    if outcomes is None:
+        outcomes = np.ones(len(win_prob))
+    scores = score_win_probs(win_prob, outcomes, eps)
+    outcomes = np.broadcast_to(
+        np.asarray(outcomes, dtype=np.float64).reshape(
+            (-1,) + (1,) * (win_prob.ndim - 1)
+        ),
+        win_prob.shape,
+    )
+    probs = np.concatenate([win_prob, 1 - win_prob]).reshape(2 * len(win_prob), -1)
+    actual = np.concatenate([outcomes, 1 - outcomes]).reshape(probs.shape)
+
+    # One bincount over all columns, each column offset by n_bins
+    n_cols = probs.shape[1]
+    bins = np.minimum((probs * n_bins).astype(np.int64), n_bins - 1)
+    bins = (bins + n_bins * np.arange(n_cols)).ravel()
+    size = n_bins * n_cols
+    count = np.bincount(bins, minlength=size).reshape(n_cols, n_bins).T
+    pred = np.bincount(bins, probs.ravel(), minlength=size).reshape(n_cols, n_bins).T
+    true = np.bincount(bins, actual.ravel(), minlength=size).reshape(n_cols, n_bins).T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_pred, frac_true = pred / count, true / count
+    ece = np.abs(pred - true).sum(axis=0) / len(probs)
+
+    if win_prob.ndim == 1:
+        count, mean_pred, frac_true, ece = (
+            count[:, 0],
+            mean_pred[:, 0],
+            frac_true[:, 0],
+            ece[0],
+        )
+    return {
+        "bin_edges": np.linspace(0, 1, n_bins + 1),
+        "count": count,
+        "mean_pred": mean_pred,
+        "frac_true": frac_true,
+        "ece": ece,
+        "brier": scores["brier"],
+        "log_loss": scores["log_loss"],
+    }
+
+
+# A and B of the inverse sigmoid recalibration (ELO.invsigmoid) with the
+# lowest log-loss, starting from the given values. Parameters that push any
+# recalibrated probability outside (0, 1) are not allowed.
+def fit_recalibration(win_prob, outcomes=None, A=5, B=0.2):
+    from scipy.optimize import minimize
+
+    win_prob = np.asarray(win_prob, dtype=np.float64)
+
+    def loss(params):
+        probs = ELO.invsigmoid(win_prob, *np.exp(params))
+        if not np.all((probs > 0) & (probs < 1)):
+            return np.inf
+        return score_win_probs(probs, outcomes)["log_loss"]
+
+    result = minimize(loss, np.log([A, B]), method="Nelder-Mead")
+    A, B = np.exp(result.x)
+    return float(A), float(B)
+
+
+# Sparse rating history that keeps only the points where each team's rating
+# changed. Ratings as of any game or date are looked up by binary search and a
+# dense frame is only assembled when asked for.
+class RatingHistory:
+    __slots__ = (
+        "competitors",
+        "team_index",
+        "team_offsets",
+        "positions",
+        "values",
+        "ids",
+        "timestamps",
+        "n_games",
+        "_id_positions",
+    )
+
+    def __init__(
+        self, competitors, team_offsets, positions, values, ids=None, timestamps=None
+    ):
+        self.competitors = list(competitors)
+        self.team_index = {team: i for i, team in enumerate(self.competitors)}
+        # Change points of team i live in positions/values[offsets[i]:offsets[i + 1]].
+        # A change at position p holds from the rating after game p onwards,
+        # with position -1 standing for the initial rating.
+        self.team_offsets = team_offsets
+        self.positions = positions
+        self.values = values
+        self.ids = ids
+        self.timestamps = None if timestamps is None else to_datetime64(timestamps)
+        self.n_games = 0 if ids is None else len(ids)
+        self._id_positions = None
+
+    @classmethod
+    def from_engine(cls, engine, ids=None, timestamps=None):
+        n, n_teams = engine.n_games, len(engine.competitors)
+        n_resets = len(engine.season_starts)
+        games = np.arange(n, dtype=np.int64)
+        # Concatenate initial ratings, season resets and game updates. On ties
+        # in position a game update must win over the reset before it.
+        teams = np.concatenate(
+            [
+                np.arange(n_teams, dtype=np.int64),
+                np.tile(np.arange(n_teams, dtype=np.int64), n_resets),
+                engine.winner_idx,
+                engine.loser_idx,
+            ]
+        )
+        positions = np.concatenate(
+            [
+                np.full(n_teams, -1, dtype=np.int64),
+                np.repeat(engine.season_starts, n_teams),
+                games,
+                games,
+            ]
+        )
+        values = np.concatenate(
+            [
+                engine.initial_ratings,
+                engine.season_snapshots.ravel(),
+                engine.winner_elo,
+                engine.loser_elo,
+            ]
+        )
+        is_game = np.concatenate(
+            [np.zeros(n_teams * (1 + n_resets), dtype=bool), np.ones(2 * n, dtype=bool)]
+        )
+        order = np.lexsort((is_game, positions, teams))
+        team_offsets = np.searchsorted(teams[order], np.arange(n_teams + 1))
+        return cls(
+            engine.competitors,
+            team_offsets,
+            positions[order],
+            values[order],
+            ids=range(n) if ids is None else ids,
+            timestamps=timestamps,
+        )
+
+    # Add the games the engine rated from log position start on, along with
+    # the teams and season resets that came with them. Every new change point
+    # comes after the existing ones of its team, so the new points are sorted
+    # on their own and inserted at the end of each team's run.
+    def extend(self, engine, start, ids=None, timestamps=None):
+        n, n_teams = engine.n_games, len(engine.competitors)
+        n_old_teams = len(self.competitors)
+        first_reset = np.searchsorted(engine.season_starts, start)
+        resets = engine.season_starts[first_reset:]
+        games = np.arange(start, n, dtype=np.int64)
+        teams = np.concatenate(
+            [
+                np.arange(n_old_teams, n_teams, dtype=np.int64),
+                np.tile(np.arange(n_teams, dtype=np.int64), len(resets)),
+                engine.winner_idx[start:],
+                engine.loser_idx[start:],
+            ]
+        )
+        positions = np.concatenate(
+            [
+                np.full(n_teams - n_old_teams, -1, dtype=np.int64),
+                np.repeat(resets, n_teams),
+                games,
+                games,
+            ]
+        )
+        values = np.concatenate(
+            [
+                engine.initial_ratings[n_old_teams:],
+                engine.season_snapshots[first_reset:].ravel(),
+                engine.winner_elo[start:],
+                engine.loser_elo[start:],
+            ]
+        )
+        is_game = np.concatenate(
+            [
+                np.zeros(n_teams - n_old_teams + n_teams * len(resets), dtype=bool),
+                np.ones(2 * len(games), dtype=bool),
+            ]
+        )
+        order = np.lexsort((is_game, positions, teams))
+        teams, positions, values = teams[order], positions[order], values[order]
+
+        # New teams start with empty runs after the last of the old ones
+        offsets = np.append(
+            self.team_offsets, np.repeat(self.team_offsets[-1], n_teams - n_old_teams)
+        )
+        at = offsets[teams + 1]
+        self.positions = np.insert(self.positions, at, positions)
+        self.values = np.insert(self.values, at, values)
+        self.team_offsets = offsets + np.append(
+            0, np.cumsum(np.bincount(teams, minlength=n_teams))
+        )
+        for team in engine.competitors[n_old_teams:]:
+            self.team_index[team] = len(self.competitors)
+            self.competitors.append(team)
+
+        ids = np.arange(start, n) if ids is None else np.asarray(ids)
+        if self._id_positions is not None:
+            self._id_positions.update(
+                (game, self.n_games + i) for i, game in enumerate(ids.tolist())
+            )
+        self.ids = np.concatenate([np.asarray(self.ids), ids])
+        # As in Games.append, a side without timestamps is filled with NaT
+        if self.timestamps is not None or timestamps is not None:
+            nat = np.datetime64("NaT", "ns")
+            old = self.timestamps
+            old = np.full(self.n_games, nat) if old is None else old
+            new = np.full(len(ids), nat) if timestamps is None else timestamps
+            self.timestamps = np.concatenate([old, to_datetime64(new)])
+        self.n_games += len(ids)
+
+    # Position of the last game played on or before a date (side="right"), or
+    # of the first game played on or after it (side="left")
+    def position_as_of(self, date, side="right"):
+        if self.timestamps is None:
+            raise ValueError("Rating history has no timestamps")
+        position = np.searchsorted(self.timestamps, as_datetime64(date), side=side)
+        return int(position) - 1 if side == "right" else int(position)
+
+    # Position of a game in the fitted order from its id
+    def position_of(self, game_id):
+        if self._id_positions is None:
+            self._id_positions = {game: i for i, game in enumerate(self.ids)}
+        return self._id_positions[game_id]
+
+    # Ratings of the given team indices after each of the given game positions
+    def lookup(self, team_indices, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        out = np.empty((len(positions), len(team_indices)), dtype=np.float64)
+        for j, team in enumerate(team_indices):
+            lo, hi = self.team_offsets[team], self.team_offsets[team + 1]
+            found = np.searchsorted(self.positions[lo:hi], positions, side="right")
+            out[:, j] = self.values[lo:hi][found - 1]
+        return out
+
+    # Rating of a team as of a game id or a date (latest rating by default)
+    def rating(self, team, game=None, date=None):
+        if game is not None:
+            position = self.position_of(game)
+        elif date is not None:
+            position = self.position_as_of(date)
+        else:
+            position = self.n_games - 1
+        return self.lookup([self.team_index[team]], [position])[0, 0]
+
+    # Change points of a single team as a series indexed by game id
+    def team_history(self, team):
+        import pandas as pd
+
+        team = self.team_index[team]
+        lo, hi = self.team_offsets[team], self.team_offsets[team + 1]
+        positions, values = self.positions[lo:hi], self.values[lo:hi]
+        # Keep only the final value where a reset and a game share a position
+        last = np.append(positions[1:] != positions[:-1], True) & (positions >= 0)
+        return pd.Series(
+            values[last],
+            index=pd.Index(np.asarray(self.ids)[positions[last]], name="id"),
+            name=self.competitors[team],
+        )
+
+    # Dense games x teams frame for a slice of games and a subset of teams
+    def to_frame(self, teams=None, start=0, stop=None):
+        import pandas as pd
+
+        teams = self.competitors if teams is None else list(teams)
+        stop = self.n_games if stop is None else stop
+        positions = np.arange(start, stop)
+        return pd.DataFrame(
+            self.lookup([self.team_index[team] for team in teams], positions),
+            columns=teams,
+            index=pd.Index(np.asarray(self.ids)[start:stop], name="id"),
+        )
+
+    @property
+    def nbytes(self):
+        return self.team_offsets.nbytes + self.positions.nbytes + self.values.nbytes
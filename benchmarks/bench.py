@@ -0,0 +1,361 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from bs4 import BeautifulSoup
+
+import scraping.parsing_functions as pf
+from ELO import ELO
+from rpi import daily_rpi
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+# Synthetic game sets as (games, teams)
+SIZES = {
+    "1k": (1_000, 50),
+    "10k": (10_000, 200),
+    "100k": (100_000, 500),
+    "1M": (1_000_000, 2_000),
+}
+PARSING_FUNCTIONS = [
+    pf.parse_team_legend,
+    pf.parse_head_coaches,
+    pf.parse_links,
+    pf.parse_records,
+    pf.parse_schedule,
+    pf.parse_team_stats,
+    pf.parse_venues,
+]
+# Configurations fit together in the sweep benchmark
+SWEEP = {"k": [16, 24, 32, 40], "elo_diff": [400, 600]}
+# ELO benchmarks run on each size, named <benchmark>[<size>]
+ELO_BENCHMARKS = [
+    "elo_init",
+    "fit_fastest",
+    "show_calibration",
+    "calibration",
+    "fit_sweep",
+    "daily_rpi",
+]
+# Modules whose import time and memory are measured in a fresh interpreter
+IMPORTS = ["ELO", "rpi"]
+# Run in the fresh interpreter: seconds to import and peak RSS in KB. ru_maxrss
+# keeps the peak of the process before exec (the benchmark runner itself) on
+# Linux, so VmHWM is read where there is one.
+IMPORT_SCRIPT = """
+import resource, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+try:
+    with open("/proc/self/status") as status:
+        rss = next(line.split()[1] for line in status if line.startswith("VmHWM"))
+except OSError:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(elapsed, rss)
+"""
+
+
+# A fixed set of n_games games between n_teams teams over the 2011-2023
+# seasons. Teams have hidden strengths and the stronger team wins more often,
+# so the ratings have something to find.
+def synthetic_games(n_games, n_teams, seed=0):
+    rng = np.random.default_rng(seed)
+    strength = rng.normal(0, 200, n_teams)
+    home = rng.integers(0, n_teams, n_games)
+    away = (home + rng.integers(1, n_teams, n_games)) % n_teams
+    home_wins = rng.random(n_games) < 1 / (
+        1 + 10 ** ((strength[away] - strength[home] - 50) / 400)
+    )
+    # Games from February through May of each season, in order
+    seasons = np.sort(rng.integers(2011, 2024, n_games))
+    days = rng.integers(31, 151, n_games)
+    order = np.lexsort((days, seasons))
+    timestamps = pd.to_datetime(
+        seasons[order].astype(str), format="%Y"
+    ) + pd.to_timedelta(days[order], unit="D")
+    home, away, home_wins = home[order], away[order], home_wins[order]
+    site = rng.choice(["home", "neutral"], n_games, p=[0.9, 0.1])
+    return pd.DataFrame(
+        {
+            "id": np.arange(n_games),
+            "timestamp": timestamps,
+            "winner": np.where(home_wins, home, away) + 1,
+            "loser": np.where(home_wins, away, home) + 1,
+            "site": np.where(home_wins | (site == "neutral"), site, "away"),
+            "margin": rng.integers(1, 11, n_games).astype(np.float64),
+        }
+    )
+
+
+# Seconds per call of func over repeat runs, each calling it often enough to
+# last at least min_seconds
+def measure(func, repeat=5, min_seconds=0.05):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds or number >= 1_000_000:
+            break
+        number *= 10
+    times = [elapsed]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append(time.perf_counter() - start)
+    times = [t / number for t in times]
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "number": number,
+        "repeat": len(times),
+    }
+
+
+# Import time of a module in fresh interpreters, like measure, with the
+# largest peak RSS (KB) of the interpreters as max_rss_kb
+def measure_import(module, repeat=5):
+    times, rss = [], []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT.format(module=module)],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split()
+        times.append(float(output[0]))
+        rss.append(int(output[1]))
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "number": 1,
+        "repeat": len(times),
+        "max_rss_kb": max(rss),
+    }
+
+
+def quietly(func):
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func()
+
+    return run
+
+
+# Benchmarks of the ELO model as (name, func) pairs for one synthetic game set
+def elo_benchmarks(size):
+    games = synthetic_games(*SIZES[size])
+
+    def init():
+        return ELO.from_frame(games, time_col="timestamp", id_col="id")
+
+    elo = init()
+    quietly(elo.fit_fastest)()
+
+    def calibration():
+        elo.show_calibration(start_year=2018)
+        plt.close("all")
+
+    def sweep():
+        return elo.fit_sweep(since=2018, grid=True, **SWEEP)
+
+    funcs = [
+        init,
+        quietly(elo.fit_fastest),
+        calibration,
+        lambda: elo.calibration(since=2018),
+        sweep,
+        lambda: daily_rpi(games),
+    ]
+    return [(f"{name}[{size}]", func) for name, func in zip(ELO_BENCHMARKS, funcs)]
+
+
+# Benchmarks of BeautifulSoup and every parsing function on each HTML
+# fixture. Functions that do not apply to a page (an old style page has no
+# venues) are left out for it.
+def parsing_benchmarks(fixtures_dir=FIXTURES_DIR):
+    benchmarks = []
+    for file in sorted(os.listdir(fixtures_dir)):
+        if not file.endswith(".html"):
+            continue
+        name = file[: -len(".html")]
+        with open(os.path.join(fixtures_dir, file)) as f:
+            html = f.read()
+        benchmarks.append(
+            (f"soup[{name}]", lambda html=html: BeautifulSoup(html, "lxml"))
+        )
+        soup = BeautifulSoup(html, "lxml")
+        for function in PARSING_FUNCTIONS:
+            try:
+                function(soup, 0, 0)
+            except Exception:
+                continue
+            benchmarks.append(
+                (
+                    f"{function.__name__}[{name}]",
+                    lambda function=function, soup=soup: function(soup, 0, 0),
+                )
+            )
+    return benchmarks
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def selected(name, match):
+    return not match or any(m in name for m in match)
+
+
+# Run the import benchmarks, the ELO benchmarks on each size and the parsing
+# benchmarks, returning the results keyed by benchmark name. Names containing
+# none of the match strings are skipped, and a size none of whose ELO
+# benchmarks are selected is never generated or fitted.
+def run(sizes=tuple(SIZES), match=None, repeat=5, parsing=True):
+    results = {}
+    for module in IMPORTS:
+        name = f"import[{module}]"
+        if not selected(name, match):
+            continue
+        results[name] = measure_import(module, repeat=repeat)
+        print(
+            f"{name:40} {results[name]['min'] * 1000:12.3f} ms "
+            f"{results[name]['max_rss_kb'] / 1024:8.1f} MB"
+        )
+    benchmarks = []
+    for size in sizes:
+        if any(selected(f"{name}[{size}]", match) for name in ELO_BENCHMARKS):
+            benchmarks += elo_benchmarks(size)
+    if parsing:
+        benchmarks += parsing_benchmarks()
+    for name, func in benchmarks:
+        if not selected(name, match):
+            continue
+        results[name] = measure(func, repeat=repeat)
+        print(f"{name:40} {results[name]['min'] * 1000:12.3f} ms")
+    return {"environment": environment(), "results": results}
+
+
+# Compare the best times of two result files. A benchmark regresses when it
+# got more than threshold (a fraction) slower than in baseline, or for the
+# import benchmarks, when its peak memory grew by more than threshold.
+def compare(baseline, current, threshold=0.1):
+    rows = []
+    for name in sorted(set(baseline["results"]) | set(current["results"])):
+        before = baseline["results"].get(name)
+        after = current["results"].get(name)
+        if before is None or after is None:
+            status = "new" if before is None else "missing"
+            rows.append(
+                (name, before and before["min"], after and after["min"], None, status)
+            )
+            continue
+        ratio = after["min"] / before["min"]
+        rss_ratio = after.get("max_rss_kb", 1) / before.get("max_rss_kb", 1)
+        if ratio > 1 + threshold or rss_ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 / (1 + threshold):
+            status = "improvement"
+        else:
+            status = "ok"
+        rows.append((name, before["min"], after["min"], ratio, status))
+    return rows
+
+
+def print_comparison(rows):
+    print(f"{'benchmark':40} {'before ms':>12} {'after ms':>12} {'ratio':>7}")
+    for name, before, after, ratio, status in rows:
+        before = "-" if before is None else f"{before * 1000:.3f}"
+        after = "-" if after is None else f"{after * 1000:.3f}"
+        ratio = "-" if ratio is None else f"{ratio:.2f}"
+        print(f"{name:40} {before:>12} {after:>12} {ratio:>7}  {status}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ELO engine and the team page parsers"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run benchmarks and save results")
+    run_parser.add_argument(
+        "--sizes", default=",".join(SIZES), help="comma separated game set sizes"
+    )
+    run_parser.add_argument("--match", nargs="*", help="only benchmarks named so")
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--no-parsing", action="store_true")
+    run_parser.add_argument(
+        "--output", help="results file (default results/<time>.json)"
+    )
+    compare_parser = commands.add_parser(
+        "compare", help="flag regressions between two result files"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.1, help="allowed slowdown fraction"
+    )
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run(
+            sizes=[size for size in args.sizes.split(",") if size],
+            match=args.match,
+            repeat=args.repeat,
+            parsing=not args.no_parsing,
+        )
+        output = args.output or os.path.join(
+            RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json"
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as file:
+            json.dump(results, file, indent=1)
+        print(f"Saved results to {output}")
+    else:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        with open(args.current) as file:
+            current = json.load(file)
+        rows = compare(baseline, current, threshold=args.threshold)
+        print_comparison(rows)
+        raise SystemExit(1 if any(row[-1] == "regression" for row in rows) else 0)
@@ -0,0 +1,284 @@
+import csv
+import hashlib
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+from common import season_of_year
+
+HISTORIES_DIR = "histories"
+HISTORIES_DB = "histories.sqlite"
+HEADER = [
+    "Year",
+    "Head Coaches",
+    "Division",
+    "Conference",
+    "Wins",
+    "Losses",
+    "Ties",
+    "WL%",
+    "Notes",
+    "team_url",
+    "coach_url",
+]
+# Histories scraped before the team and coach links were kept have no link
+# columns, their rows are merged with empty links
+LINK_COLS = ["team_url", "coach_url"]
+COLUMNS = [
+    "school_id",
+    "season",
+    "year",
+    "head_coaches",
+    "division",
+    "conference",
+    "wins",
+    "losses",
+    "ties",
+    "wl_pct",
+    "notes",
+    "team_url",
+    "coach_url",
+    "team_id",
+]
+
+
+def connect(path=HISTORIES_DB):
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""CREATE TABLE IF NOT EXISTS files (
+            name TEXT PRIMARY KEY,
+            school_id INTEGER NOT NULL,
+            mtime REAL,
+            size INTEGER,
+            sha256 TEXT,
+            rows INTEGER,
+            error TEXT,
+            merged REAL
+        )""")
+    connection.execute("""CREATE TABLE IF NOT EXISTS histories (
+            school_id INTEGER NOT NULL,
+            season INTEGER NOT NULL,
+            year TEXT,
+            head_coaches TEXT,
+            division TEXT,
+            conference TEXT,
+            wins INTEGER,
+            losses INTEGER,
+            ties INTEGER,
+            wl_pct REAL,
+            notes TEXT,
+            team_url TEXT,
+            coach_url TEXT,
+            team_id INTEGER,
+            PRIMARY KEY (school_id, season)
+        ) WITHOUT ROWID""")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS histories_season ON histories (season)"
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS histories_team_id ON histories (team_id)"
+    )
+    return connection
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def to_int(value):
+    value = value.replace(",", "")
+    return int(value) if value.isdigit() else None
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+# Reason the header of a history file can not be merged, None when it can
+def check_header(header):
+    if header == HEADER or header == HEADER[: -len(LINK_COLS)]:
+        return None
+    missing = [column for column in HEADER if column not in header]
+    extra = [column for column in header if column not in HEADER]
+    return f"unexpected header (missing {missing}, extra {extra})"
+
+
+# Rows of a history file as tuples of COLUMNS, read one at a time
+def history_rows(reader, school_id):
+    for row in reader:
+        if not row:
+            continue
+        row = row + [""] * (len(HEADER) - len(row))
+        year, coaches, division, conference, wins, losses, ties, pct, notes = row[:9]
+        team_url, coach_url = row[9:11]
+        team_id = team_url.rstrip("/").split("/")[-1] if team_url else ""
+        yield (
+            school_id,
+            season_of_year(year),
+            year,
+            coaches or None,
+            division or None,
+            conference or None,
+            to_int(wins),
+            to_int(losses),
+            to_int(ties),
+            to_float(pct),
+            notes or None,
+            team_url or None,
+            coach_url or None,
+            to_int(team_id),
+        )
+
+
+# Replace the rows of one school with those of its history file in a single
+# transaction. A file with an unexpected header is recorded with the error
+# and its school keeps whatever rows it had. Returns the error, if any.
+def merge_file(connection, path, school_id, mtime, size, sha256):
+    name = os.path.basename(path)
+    with open(path, newline="") as file:
+        reader = csv.reader(file)
+        error = check_header(next(reader, []))
+        connection.execute("BEGIN")
+        try:
+            if error is None:
+                connection.execute(
+                    "DELETE FROM histories WHERE school_id = ?", (school_id,)
+                )
+                # A season listed twice keeps its first (most recent) row
+                connection.executemany(
+                    f"INSERT OR IGNORE INTO histories ({', '.join(COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                    history_rows(reader, school_id),
+                )
+            connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, "
+                "(SELECT COUNT(*) FROM histories WHERE school_id = ?), ?, ?)",
+                (name, school_id, mtime, size, sha256, school_id, error, time.time()),
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+    return error
+
+
+# Bring the merged histories in db_path up to date with histories_dir. Files
+# with the same size and mtime as when they were last merged are skipped
+# without being read, files that were touched but hash the same only have
+# their mtime updated, and schools whose file is gone are removed. force
+# merges every file again. Returns the names of the merged, unchanged,
+# removed and rejected files.
+def merge_histories(histories_dir=HISTORIES_DIR, db_path=HISTORIES_DB, force=False):
+    connection = connect(db_path)
+    known = {
+        name: (mtime, size, sha256)
+        for name, mtime, size, sha256 in connection.execute(
+            "SELECT name, mtime, size, sha256 FROM files"
+        )
+    }
+    report = {"merged": [], "unchanged": [], "removed": [], "rejected": []}
+    seen = set()
+    for name in sorted(os.listdir(histories_dir)):
+        if not (name.startswith("history_") and name.endswith(".csv")):
+            continue
+        seen.add(name)
+        path = os.path.join(histories_dir, name)
+        school_id = int(name[len("history_") : -len(".csv")])
+        stat = os.stat(path)
+        previous = known.get(name)
+        if not force and previous is not None:
+            if previous[:2] == (stat.st_mtime, stat.st_size):
+                report["unchanged"].append(name)
+                continue
+            sha256 = file_hash(path)
+            if previous[2] == sha256:
+                connection.execute(
+                    "UPDATE files SET mtime = ?, size = ? WHERE name = ?",
+                    (stat.st_mtime, stat.st_size, name),
+                )
+                report["unchanged"].append(name)
+                continue
+        else:
+            sha256 = file_hash(path)
+        error = merge_file(
+            connection, path, school_id, stat.st_mtime, stat.st_size, sha256
+        )
+        report["rejected" if error else "merged"].append(name)
+
+    for name in sorted(set(known) - seen):
+        school_id = int(name[len("history_") : -len(".csv")])
+        connection.execute("BEGIN")
+        connection.execute("DELETE FROM histories WHERE school_id = ?", (school_id,))
+        connection.execute("DELETE FROM files WHERE name = ?", (name,))
+        connection.execute("COMMIT")
+        report["removed"].append(name)
+    connection.close()
+    return report
+
+
+# Merged histories, optionally only those of some schools and seasons (first,
+# last), answered from the (school_id, season) key and season index
+def load_histories(db_path=HISTORIES_DB, school_ids=None, seasons=None):
+    query = "SELECT * FROM histories WHERE 1"
+    params = []
+    if school_ids is not None:
+        school_ids = [int(school_id) for school_id in school_ids]
+        query += f" AND school_id IN ({', '.join('?' * len(school_ids))})"
+        params += school_ids
+    if seasons is not None:
+        query += " AND season BETWEEN ? AND ?"
+        params += [seasons[0], seasons[-1]]
+    connection = sqlite3.connect(db_path)
+    histories = pd.read_sql_query(
+        query + " ORDER BY school_id, season", connection, params=params
+    )
+    connection.close()
+    return histories
+
+
+# Every team season with a team page, as the crawler takes them
+def team_urls(db_path=HISTORIES_DB):
+    connection = sqlite3.connect(db_path)
+    teams = pd.read_sql_query(
+        "SELECT school_id, team_id, team_url, division, year FROM histories "
+        "WHERE team_url IS NOT NULL ORDER BY school_id, season DESC",
+        connection,
+    )
+    connection.close()
+    return teams
+
+
+# Write the merged histories as one CSV with a header row, streaming rows
+# from the database
+def export_csv(path, db_path=HISTORIES_DB):
+    connection = sqlite3.connect(db_path)
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        writer.writerows(
+            connection.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM histories "
+                "ORDER BY school_id, season"
+            )
+        )
+    connection.close()
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    report = merge_histories()
+    print(
+        ", ".join(f"{len(names)} {key}" for key, names in report.items()),
+        f"in {time.perf_counter() - start:.2f}s",
+    )
+    for name in report["rejected"]:
+        print(f"Rejected {name}")
@@ -0,0 +1,204 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from common import SCHEDULE_COLS
+
+START_YEAR = 2011
+SCHEDULE_FOLDER = "D-I Cleaned/schedules/"
+SCHOOLS_CSV = "general_data/schools.csv"
+GAMES_CSV = "games_2011_to_2023.csv"
+RENAMED_COLS = [
+    "contest_id",
+    "date",
+    "site",
+    "school",
+    "result",
+    "gs",
+    "ga",
+    "opponent_school",
+    "school_id",
+    "opponent_school_id",
+    "attendance",
+    "notes",
+]
+SITES = ["home", "away", "neutral"]
+RESULTS = ["W", "L", "T"]
+
+
+# Season labels ("2010-11") of every season from start_year up to end_year,
+# each named by the spring it ends in
+def season_labels(start_year=START_YEAR, end_year=2024):
+    return [
+        str(year - 1) + "-" + str(year % 100).zfill(2)
+        for year in range(start_year, end_year)
+    ]
+
+
+def load_schools(path=SCHOOLS_CSV):
+    schools = pd.read_csv(
+        path, skiprows=1, header=None, names=["school_id", "school_name"]
+    )
+    return schools.set_index("school_id").school_name
+
+
+# Read the scraped schedule CSVs (no header row) of the given seasons into one
+# frame, tagging every row with its season
+def read_schedules(folder=SCHEDULE_FOLDER, seasons=None):
+    seasons = season_labels() if seasons is None else seasons
+    frames = []
+    for season in seasons:
+        path = os.path.join(folder, season + ".csv")
+        if not os.path.exists(path):
+            continue
+        frame = pd.read_csv(
+            path,
+            header=None,
+            names=SCHEDULE_COLS,
+            dtype={col: str for col in SCHEDULE_COLS[2:]},
+        )
+        frame["season"] = season
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=SCHEDULE_COLS + ["season"])
+    return pd.concat(frames, ignore_index=True)
+
+
+# The expected categories first, followed by any others found in values
+def categories(values, expected):
+    found = pd.unique(values.dropna())
+    return expected + sorted(set(found) - set(expected))
+
+
+# Turn raw scraped schedule rows of any number of seasons into one row per team
+# per game with its opponent, as clean_schedule in schedule_cleaning.ipynb did
+# season by season:
+# - site is away for "@" games, neutral when the notes start with "@" and home
+#   otherwise
+# - games against schools not in schools, or whose contest only one of our
+#   schools lists (non D-I opponents), are dropped, as are canceled and
+#   postponed games and results that are not "W 12-9" style scores
+# - every row is paired with the other team's row of the same contest
+# school, site and result come back as categoricals and the season label is
+# kept as an extra column.
+def clean_schedules(raw, schools):
+    s = raw.copy()
+    s["site"] = np.select(
+        [
+            s.site.eq("@").to_numpy(),
+            s.notes.str.startswith("@").fillna(False).to_numpy(dtype=bool),
+            s.site.isna().to_numpy(),
+        ],
+        ["away", "neutral", "home"],
+        default=s.site.astype(object).to_numpy(),
+    )
+    s["school_name"] = s.school_id.map(schools)
+    s = s.loc[s.school_name.notna()]
+
+    s = s.loc[s.result.notna() & (s.result != "Canceled") & (s.result != "Ppd")]
+    # Contest ids as integers so pairing the two sides of a game is an integer
+    # hash join rather than one on URL strings
+    s["contest_url"] = pd.to_numeric(
+        s.contest_url.str.split("/").str[2], errors="coerce"
+    ).astype("Int64")
+    s = s.loc[s.contest_url.notna()]
+    # Rows scraped twice for the same team would pair up with each other, so
+    # keep one per team and contest before looking for opponents
+    s = s.drop_duplicates(["contest_url", "school_id"])
+    # Contests only one school lists are against teams we do not track
+    s = s.loc[s.groupby("contest_url").contest_url.transform("size") > 1]
+
+    # "W 12-9 (2OT)" -> W, 12, 9
+    scores = s.result.str.replace("-", " ").str.split(n=3, expand=True)
+    scores = scores.reindex(columns=range(3))
+    gs = pd.to_numeric(scores[1], errors="coerce")
+    ga = pd.to_numeric(scores[2].str.replace(r"\D.*$", "", regex=True), errors="coerce")
+    scored = gs.notna() & ga.notna()
+    s = s.loc[scored]
+    s["wl"] = scores[0][scored]
+    s["gs"] = gs[scored].astype(np.int16)
+    s["ga"] = ga[scored].astype(np.int16)
+
+    opponents = s[["contest_url", "school_id"]].rename(
+        columns={"school_id": "opponent_school_id"}
+    )
+    s = s.merge(opponents, on="contest_url")
+    s = s.loc[s.school_id != s.opponent_school_id]
+
+    games = pd.DataFrame(
+        {
+            "contest_id": s.contest_url.astype(np.int64).to_numpy(),
+            "date": pd.to_datetime(s.date).to_numpy(),
+            "site": pd.Categorical(s.site, categories=categories(s.site, SITES)),
+            "school": pd.Categorical(s.school_name),
+            "result": pd.Categorical(s.wl, categories=categories(s.wl, RESULTS)),
+            "gs": s.gs.to_numpy(),
+            "ga": s.ga.to_numpy(),
+            "opponent_school": pd.Categorical(s.opponent),
+            "school_id": s.school_id.to_numpy(),
+            "opponent_school_id": s.opponent_school_id.to_numpy(),
+            "attendance": s.attendance.to_numpy(),
+            "notes": s.notes.to_numpy(),
+            "season": s.season.to_numpy(),
+        }
+    )
+    return games
+
+
+# Bring the games CSV up to date with the scraped schedules. Only seasons that
+# are missing from it, or whose schedule file changed since it was written,
+# are cleaned again; the other seasons are kept as they are.
+def update_games(
+    games_csv=GAMES_CSV,
+    folder=SCHEDULE_FOLDER,
+    schools=None,
+    seasons=None,
+    force=False,
+):
+    seasons = season_labels() if seasons is None else seasons
+    schools = load_schools() if schools is None else schools
+    games = None
+    written = 0
+    if os.path.exists(games_csv) and not force:
+        games = pd.read_csv(games_csv, parse_dates=["date"])
+        written = os.path.getmtime(games_csv)
+    if games is None or "season" not in games:
+        stale = list(seasons)
+        games = None
+    else:
+        cleaned = set(games.season.unique())
+        stale = []
+        for season in seasons:
+            path = os.path.join(folder, season + ".csv")
+            if os.path.exists(path) and (
+                season not in cleaned or os.path.getmtime(path) > written
+            ):
+                stale.append(season)
+    if not stale:
+        return games, []
+
+    new_games = clean_schedules(read_schedules(folder, stale), schools)
+    if games is not None:
+        games = pd.concat(
+            [games.loc[~games.season.isin(stale)], new_games], ignore_index=True
+        )
+        for column, expected in [
+            ("site", SITES),
+            ("school", []),
+            ("result", RESULTS),
+            ("opponent_school", []),
+        ]:
+            games[column] = pd.Categorical(
+                games[column], categories=categories(games[column], expected)
+            )
+    else:
+        games = new_games
+    games = games.sort_values(["date", "contest_id"], kind="stable")
+    games.to_csv(games_csv, index=False)
+    return games, stale
+
+
+if __name__ == "__main__":
+    games, cleaned = update_games()
+    print(f"Cleaned {len(cleaned)} seasons, {len(games)} game rows in {GAMES_CSV}")
@@ -0,0 +1,28 @@
+import pandas as pd
+
+# Columns of the per-season schedule CSVs written by the scrapers and of
+# games_2011_to_2023.csv after cleaning
+SCHEDULE_COLS = [
+    "school_id",
+    "team_id",
+    "date",
+    "site",
+    "opponent",
+    "opponent_url",
+    "notes",
+    "opponent_img_url",
+    "result",
+    "contest_url",
+    "attendance",
+]
+
+
+# Season of a "2023-24" style year label, named by the spring it ends in
+def season_of_year(year):
+    return int(year[:4]) + 1
+
+
+# Season of each date: games from August on belong to the next spring
+def season_of_date(dates):
+    dates = pd.DatetimeIndex(dates)
+    return dates.year + (dates.month >= 8)
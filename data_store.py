@@ -0,0 +1,260 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cleaning.merge_histories import (
+    HISTORIES_DB,
+    HISTORIES_DIR,
+    load_histories,
+    merge_histories,
+)
+from common import SCHEDULE_COLS, season_of_date, season_of_year
+from ELO import ELO
+
+GAME_COLS = [
+    "contest_id",
+    "date",
+    "site",
+    "school",
+    "result",
+    "gs",
+    "ga",
+    "opponent_school",
+    "school_id",
+    "opponent_school_id",
+    "attendance",
+    "notes",
+]
+
+# Arrow types of every stored column. Partition columns (division, season)
+# are kept out of the files and restored from the directory names.
+HISTORY_SCHEMA = pa.schema(
+    [
+        ("school_id", pa.int32()),
+        ("team_id", pa.int64()),
+        ("year", pa.string()),
+        ("head_coaches", pa.string()),
+        ("conference", pa.dictionary(pa.int32(), pa.string())),
+        ("wins", pa.int16()),
+        ("losses", pa.int16()),
+        ("ties", pa.int16()),
+        ("wl_pct", pa.float32()),
+        ("notes", pa.string()),
+        ("team_url", pa.string()),
+        ("coach_url", pa.string()),
+        ("division", pa.string()),
+        ("season", pa.int16()),
+    ]
+)
+SCHEDULE_SCHEMA = pa.schema(
+    [
+        ("school_id", pa.int32()),
+        ("team_id", pa.int64()),
+        ("date", pa.timestamp("ns")),
+        ("site", pa.dictionary(pa.int8(), pa.string())),
+        ("opponent", pa.string()),
+        ("opponent_url", pa.string()),
+        ("notes", pa.string()),
+        ("opponent_img_url", pa.string()),
+        ("result", pa.string()),
+        ("contest_url", pa.string()),
+        ("attendance", pa.int32()),
+        ("division", pa.string()),
+        ("season", pa.int16()),
+    ]
+)
+GAME_SCHEMA = pa.schema(
+    [
+        ("contest_id", pa.int64()),
+        ("date", pa.timestamp("ns")),
+        ("site", pa.dictionary(pa.int8(), pa.string())),
+        ("school", pa.dictionary(pa.int32(), pa.string())),
+        ("result", pa.dictionary(pa.int8(), pa.string())),
+        ("gs", pa.int16()),
+        ("ga", pa.int16()),
+        ("opponent_school", pa.dictionary(pa.int32(), pa.string())),
+        ("school_id", pa.int32()),
+        ("opponent_school_id", pa.int32()),
+        ("attendance", pa.int32()),
+        ("notes", pa.string()),
+        ("division", pa.string()),
+        ("season", pa.int16()),
+    ]
+)
+# Integer columns read back as nullable pandas integers, so that columns
+# with missing values keep their type instead of turning into float64
+NULLABLE_INTS = {
+    pa.int8(): pd.Int8Dtype(),
+    pa.int16(): pd.Int16Dtype(),
+    pa.int32(): pd.Int32Dtype(),
+    pa.int64(): pd.Int64Dtype(),
+}
+PARTITIONS = {
+    "histories": ["division"],
+    "schedules": ["division", "season"],
+    "games": ["division", "season"],
+}
+SCHEMAS = {
+    "histories": HISTORY_SCHEMA,
+    "schedules": SCHEDULE_SCHEMA,
+    "games": GAME_SCHEMA,
+}
+
+
+# Numbers written with thousands separators ("1,024"), missing when blank
+def to_int(values):
+    values = pd.Series(values, dtype="string").str.replace(",", "")
+    return pd.to_numeric(values, errors="coerce").astype("Int64")
+
+
+# Write df as the named dataset under root, replacing only the partitions it
+# contains so tables can be built up a season or a division at a time
+def write_table(df, root, name):
+    schema = SCHEMAS[name]
+    table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+    pq.write_to_dataset(
+        table,
+        os.path.join(root, name),
+        partition_cols=PARTITIONS[name],
+        existing_data_behavior="delete_matching",
+    )
+
+
+# Read the named dataset. columns projects, and filters (pyarrow filter tuples
+# such as [("season", ">=", 2020)]) are pushed down so only matching
+# partitions and row groups are read.
+def read_table(root, name, columns=None, filters=None):
+    table = pq.read_table(
+        os.path.join(root, name),
+        columns=columns,
+        filters=filters,
+        schema=SCHEMAS[name],
+        partitioning="hive",
+    )
+    return table.to_pandas(types_mapper=NULLABLE_INTS.get)
+
+
+# Store the merged histories (cleaning/merge_histories.py) as one dataset,
+# bringing them up to date with the history files first
+def write_histories(root, histories_dir=HISTORIES_DIR, db_path=HISTORIES_DB):
+    merge_histories(histories_dir, db_path)
+    histories = load_histories(db_path)
+    for column in ["wins", "losses", "ties", "team_id"]:
+        histories[column] = histories[column].astype("Int64")
+    write_table(histories, root, "histories")
+    return len(histories)
+
+
+# Store the scraped per-season schedule CSVs of one division, e.g. the
+# <division>/schedules/<year>.csv files written by the crawler
+def write_schedules(root, schedules_dir, division):
+    schedules = []
+    for file in sorted(os.listdir(schedules_dir)):
+        if not file.endswith(".csv"):
+            continue
+        schedule = pd.read_csv(
+            os.path.join(schedules_dir, file),
+            header=None,
+            names=SCHEDULE_COLS,
+            dtype=str,
+        )
+        schedule["season"] = season_of_year(file[: -len(".csv")])
+        schedules.append(schedule)
+    schedules = pd.concat(schedules, ignore_index=True)
+    schedules["division"] = division
+    schedules["date"] = pd.to_datetime(
+        schedules.date, format="%m/%d/%Y", errors="coerce"
+    )
+    for column in ["school_id", "team_id", "attendance"]:
+        schedules[column] = to_int(schedules[column])
+    write_table(schedules, root, "schedules")
+    return len(schedules)
+
+
+# Store cleaned games (the output of cleaning/schedule_cleaning.ipynb, one
+# row per team per game) for one division
+def write_games(root, games_csv="games_2011_to_2023.csv", division="D-I"):
+    games = pd.read_csv(games_csv, dtype=str)[GAME_COLS]
+    games["division"] = division
+    games["date"] = pd.to_datetime(games.date)
+    games["season"] = season_of_date(games.date)
+    for column in [
+        "contest_id",
+        "gs",
+        "ga",
+        "school_id",
+        "opponent_school_id",
+        "attendance",
+    ]:
+        games[column] = to_int(games[column])
+    write_table(games, root, "games")
+    return len(games)
+
+
+# Games in the store as the winner/loser rows ELO takes: winners of every
+# decided game (each game is stored once per team) and, with ties set, one
+# row per tied game. Only the needed columns are read, and seasons (first,
+# last) and division are pushed down to the partitions.
+def load_elo_games(root, seasons=None, division=None, ties=False):
+    filters = []
+    if seasons is not None:
+        filters.append(("season", ">=", seasons[0]))
+        filters.append(("season", "<=", seasons[-1]))
+    if division is not None:
+        filters.append(("division", "==", division))
+    filters.append(("result", "in", ["W", "T"] if ties else ["W"]))
+    games = read_table(
+        root,
+        "games",
+        columns=[
+            "contest_id",
+            "date",
+            "site",
+            "school_id",
+            "opponent_school_id",
+            "gs",
+            "ga",
+        ],
+        filters=filters,
+    )
+    # Tied games show up once per side, keep the first. Games without an id
+    # can not be told apart, so they are left out.
+    games = games.dropna(subset=["opponent_school_id", "contest_id"])
+    games = games.drop_duplicates("contest_id").sort_values("date", kind="stable")
+    return pd.DataFrame(
+        {
+            "id": games.contest_id.to_numpy(np.int64),
+            "timestamp": games.date.to_numpy(),
+            "site": games.site.astype(str).to_numpy(),
+            "winner": games.school_id.to_numpy(np.int64),
+            "loser": games.opponent_school_id.to_numpy(np.int64),
+            "margin": (games.gs - games.ga).to_numpy(np.float64, na_value=np.nan),
+        }
+    )
+
+
+# ELO model over the stored games, e.g. elo_from_store("data", seasons=(2011,
+# 2023), division="D-I", k=32). Margins are passed on when margin_of_victory
+# or ties is set, each switching on only its own use of them.
+def elo_from_store(
+    root, seasons=None, division=None, margin_of_victory=False, ties=False, **kwargs
+):
+    games = load_elo_games(root, seasons=seasons, division=division, ties=ties)
+    return ELO.from_frame(
+        games,
+        time_col="timestamp",
+        id_col="id",
+        site_col="site",
+        margin_col="margin" if margin_of_victory or ties else None,
+        margin_of_victory=margin_of_victory,
+        ties=ties,
+        **kwargs,
+    )
+
+
+if __name__ == "__main__":
+    print(f"Stored {write_histories('data')} history rows")
+    print(f"Stored {write_games('data')} game rows")
@@ -0,0 +1,199 @@
+import itertools
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from ELO import (
+    ELO,
+    as_datetime64,
+    calibration_scores,
+    find_season_starts,
+    score_win_probs,
+    update_ratings,
+)
+
+# Metrics where a larger value is better, everything else is minimized
+MAXIMIZED_METRICS = {"accuracy"}
+
+# Defaults for every configuration key a worker understands. season_start_month
+# sets the month a new season begins in (1 = calendar year, None = no resets),
+# A and B apply the inverse sigmoid recalibration used by show_calibration.
+DEFAULT_CONFIG = {
+    "k": 20,
+    "elo_diff": 400,
+    "seasonal_mean_reversion": 0.0,
+    "home_advantage": 0.0,
+    "margin_of_victory": False,
+    "season_start_month": 1,
+    "A": None,
+    "B": None,
+}
+
+
+# Encoded games of a fitted ELO placed in shared memory once so that worker
+# processes can attach to them instead of unpickling the game list per task.
+# A model without timestamps shares none and is fit without season resets.
+class SharedGames:
+    def __init__(self, elo):
+        arrays = {
+            "winner_idx": elo.winner_idx,
+            "loser_idx": elo.loser_idx,
+            "site_signs": (
+                np.zeros(len(elo.games), dtype=np.int8)
+                if elo.games.site_signs is None
+                else elo.games.site_signs
+            ),
+            "margins": (
+                np.zeros(len(elo.games)) if elo.margins is None else elo.margins
+            ),
+            "outcomes": elo.get_outcomes(),
+        }
+        if elo.timestamps is not None:
+            arrays["timestamps"] = elo.timestamps.view(np.int64)
+        self.blocks = []
+        self.spec = {
+            "n_teams": len(elo.competitors),
+            "elo_init": elo.elo_init,
+            "ties": elo.ties,
+            "has_margins": elo.margins is not None,
+            "arrays": {},
+        }
+        for name, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+            self.blocks.append(block)
+            self.spec["arrays"][name] = (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Per-process view of the shared games, filled in by _attach_shared_games
+_shared = {}
+
+
+def _attach_shared_games(spec, score_start):
+    _shared.update(spec, score_start=score_start, blocks=[])
+    for name, (block_name, shape, dtype) in spec["arrays"].items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared["blocks"].append(block)
+        _shared[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    _shared["seasons"] = {}
+
+
+# Season of every game under a season boundary rule, cached per worker. Games
+# without timestamps are all one season.
+def _seasons(season_start_month):
+    if season_start_month is None or "timestamps" not in _shared:
+        return None
+    if season_start_month not in _shared["seasons"]:
+        months = _shared["timestamps"].astype("datetime64[ns]").astype("datetime64[M]")
+        years = months.astype(np.int64) // 12 + 1970
+        month_of_year = months.astype(np.int64) % 12 + 1
+        _shared["seasons"][season_start_month] = years + (
+            month_of_year >= season_start_month
+        )
+    return _shared["seasons"][season_start_month]
+
+
+# Fit and score a single configuration against the shared games
+def evaluate_config(config):
+    config = {**DEFAULT_CONFIG, **config}
+    ratings = np.full(_shared["n_teams"], _shared["elo_init"], dtype=np.float64)
+    win_prob, _, _, _ = update_ratings(
+        ratings,
+        _shared["winner_idx"],
+        _shared["loser_idx"],
+        find_season_starts(_seasons(config["season_start_month"])),
+        k=config["k"],
+        elo_diff=config["elo_diff"],
+        seasonal_mean_reversion=config["seasonal_mean_reversion"],
+        site_signs=_shared["site_signs"],
+        home_advantage=config["home_advantage"],
+        margins=_shared["margins"] if _shared["has_margins"] else None,
+        mov=float(config["margin_of_victory"]),
+        ties=_shared["ties"],
+        record_ratings=False,
+    )
+    win_prob = win_prob[_shared["score_start"] :]
+    outcomes = _shared["outcomes"][_shared["score_start"] :]
+    if config["A"] is not None:
+        win_prob = ELO.invsigmoid(win_prob, config["A"], config["B"])
+    scores = score_win_probs(win_prob, outcomes)
+    scores["ece"] = calibration_scores(win_prob, outcomes)["ece"]
+    return {key: float(value) for key, value in scores.items()}
+
+
+# Every combination of the given parameter values as a list of configurations
+def param_grid(**params):
+    keys = list(params)
+    return [
+        dict(zip(keys, values))
+        for values in itertools.product(*(np.atleast_1d(params[k]) for k in keys))
+    ]
+
+
+# Evaluate configurations across a process pool. Games are shared with the
+# workers through shared memory and only configs and scores cross process
+# boundaries. With patience set, the search stops once that many consecutive
+# results fail to improve the best metric by more than min_delta.
+def parallel_search(
+    elo,
+    configs,
+    since=None,
+    metric="log_loss",
+    patience=None,
+    min_delta=0.0,
+    max_workers=None,
+):
+    sign = -1 if metric in MAXIMIZED_METRICS else 1
+    score_start = 0
+    if since is not None:
+        assert elo.timestamps is not None, "since needs a model with timestamps"
+        score_start = int(np.searchsorted(elo.timestamps, as_datetime64(since)))
+
+    max_workers = max_workers or os.cpu_count()
+    results = []
+    configs = iter(enumerate(configs))
+    best, since_best = np.inf, 0
+    with SharedGames(elo) as games, ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_attach_shared_games,
+        initargs=(games.spec, score_start),
+    ) as pool:
+        # Keep a bounded number of tasks in flight so that stopping early does
+        # not leave the whole grid queued behind it
+        in_flight = 2 * max_workers
+        pending = {}
+        for i, config in itertools.islice(configs, in_flight):
+            pending[pool.submit(evaluate_config, config)] = (i, config)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, config = pending.pop(future)
+                scores = future.result()
+                results.append({"order": i, **config, **scores})
+                if sign * scores[metric] < best - min_delta:
+                    best, since_best = sign * scores[metric], 0
+                else:
+                    since_best += 1
+            if patience is not None and since_best >= patience:
+                for future in pending:
+                    future.cancel()
+                break
+            for i, config in itertools.islice(configs, len(done)):
+                pending[pool.submit(evaluate_config, config)] = (i, config)
+
+    return pd.DataFrame(results).sort_values("order").set_index("order")
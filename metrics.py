@@ -0,0 +1,318 @@
+import json
+import sys
+import threading
+import time
+
+# Timers, counters and gauges for the hot paths of fitting, crawling and
+# parsing. Everything is off until enable() is called; until then timer()
+# hands back a shared do-nothing context and count()/gauge() return right
+# away, so instrumented code costs a function call and a flag check.
+# Metrics are keyed by name and labels, e.g.
+#   with metrics.timer("elo_stage_seconds", stage="validate"): ...
+#   metrics.count("crawl_rows_written_total", len(rows), table="schedules")
+# and exported with snapshot()/to_json() or to_prometheus().
+
+ENABLED = False
+# (name, labels) -> [count, sum, min, max] of timed seconds
+TIMERS = {}
+# (name, labels) -> total
+COUNTERS = {}
+# (name, labels) -> [last value, max value]
+GAUGES = {}
+# Object with start() and stop() run while metrics are enabled, e.g. a
+# SamplingProfiler
+PROFILER = None
+LOCK = threading.Lock()
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    __slots__ = ("key", "start")
+
+    def __init__(self, key):
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe_key(self.key, time.perf_counter() - self.start)
+        return False
+
+
+def key_of(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+# Time the body of a with block under name and labels
+def timer(name, **labels):
+    if not ENABLED:
+        return NULL_TIMER
+    return Timer(key_of(name, labels))
+
+
+# Record seconds measured elsewhere (e.g. across an await) as a timing
+def observe(name, seconds, **labels):
+    if ENABLED:
+        observe_key(key_of(name, labels), seconds)
+
+
+def observe_key(key, seconds):
+    with LOCK:
+        stats = TIMERS.get(key)
+        if stats is None:
+            TIMERS[key] = [1, seconds, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = min(stats[2], seconds)
+            stats[3] = max(stats[3], seconds)
+
+
+def count(name, value=1, **labels):
+    if not ENABLED:
+        return
+    key = key_of(name, labels)
+    with LOCK:
+        COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+
+# Set a level such as a queue depth, keeping the highest value seen
+def gauge(name, value, **labels):
+    if not ENABLED:
+        return
+    key = key_of(name, labels)
+    with LOCK:
+        previous = GAUGES.get(key)
+        GAUGES[key] = [value, value if previous is None else max(previous[1], value)]
+
+
+def enabled():
+    return ENABLED
+
+
+# Start recording, and run profiler (anything with start() and stop(), such
+# as SamplingProfiler()) until disable()
+def enable(profiler=None):
+    global ENABLED, PROFILER
+    ENABLED = True
+    if profiler is not None:
+        PROFILER = profiler
+        PROFILER.start()
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+    if PROFILER is not None:
+        PROFILER.stop()
+
+
+# Drop everything recorded so far, including the profiler
+def reset():
+    global PROFILER
+    with LOCK:
+        TIMERS.clear()
+        COUNTERS.clear()
+        GAUGES.clear()
+    PROFILER = None
+
+
+# Everything recorded as plain JSON-able data
+def snapshot():
+    with LOCK:
+        data = {
+            "timers": [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": n,
+                    "sum": total,
+                    "min": low,
+                    "max": high,
+                }
+                for (name, labels), (n, total, low, high) in TIMERS.items()
+            ],
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in COUNTERS.items()
+            ],
+            "gauges": [
+                {"name": name, "labels": dict(labels), "value": value, "max": high}
+                for (name, labels), (value, high) in GAUGES.items()
+            ],
+        }
+    if isinstance(PROFILER, SamplingProfiler):
+        data["samples"] = PROFILER.stacks()
+    return data
+
+
+# Add a snapshot taken elsewhere (e.g. in a worker process) to these metrics
+def merge(data):
+    with LOCK:
+        for entry in data["timers"]:
+            key = key_of(entry["name"], entry["labels"])
+            stats = TIMERS.get(key)
+            if stats is None:
+                TIMERS[key] = [entry["count"], entry["sum"], entry["min"], entry["max"]]
+            else:
+                stats[0] += entry["count"]
+                stats[1] += entry["sum"]
+                stats[2] = min(stats[2], entry["min"])
+                stats[3] = max(stats[3], entry["max"])
+        for entry in data["counters"]:
+            key = key_of(entry["name"], entry["labels"])
+            COUNTERS[key] = COUNTERS.get(key, 0) + entry["value"]
+        for entry in data["gauges"]:
+            key = key_of(entry["name"], entry["labels"])
+            previous = GAUGES.get(key)
+            high = entry["max"] if previous is None else max(previous[1], entry["max"])
+            GAUGES[key] = [entry["value"], high]
+
+
+# Call func with fresh metrics enabled and return its result along with what
+# it recorded, leaving the metrics of the calling process as they were. For
+# work sent to a process pool, whose processes do not share the metrics of
+# the parent: the parent merge()s the returned snapshot.
+def measured(func, *args, **kwargs):
+    global ENABLED, TIMERS, COUNTERS, GAUGES
+    saved = ENABLED, TIMERS, COUNTERS, GAUGES
+    ENABLED, TIMERS, COUNTERS, GAUGES = True, {}, {}, {}
+    try:
+        result = func(*args, **kwargs)
+        data = snapshot()
+    finally:
+        ENABLED, TIMERS, COUNTERS, GAUGES = saved
+    data.pop("samples", None)
+    return result, data
+
+
+def to_json(indent=1):
+    return json.dumps(snapshot(), indent=indent, default=float)
+
+
+def label_text(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+# Metrics in the Prometheus text exposition format: timers as summaries
+# (<name>_count and <name>_sum) with a <name>_max gauge, counters and gauges
+# as they are with a <name>_max gauge for the peak of each gauge
+def to_prometheus():
+    lines = []
+
+    def family(name, kind, samples):
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(
+            f"{sample}{label_text(labels)} {float(value)!r}"
+            for sample, labels, value in samples
+        )
+
+    with LOCK:
+        timers = sorted(TIMERS.items())
+        counters = sorted(COUNTERS.items())
+        gauges = sorted(GAUGES.items())
+    for name in dict.fromkeys(name for (name, _), _ in timers):
+        rows = [(labels, stats) for (n, labels), stats in timers if n == name]
+        family(
+            name,
+            "summary",
+            [(f"{name}_count", labels, stats[0]) for labels, stats in rows]
+            + [(f"{name}_sum", labels, stats[1]) for labels, stats in rows],
+        )
+        family(
+            f"{name}_max",
+            "gauge",
+            [(f"{name}_max", labels, stats[3]) for labels, stats in rows],
+        )
+    for name in dict.fromkeys(name for (name, _), _ in counters):
+        family(
+            name,
+            "counter",
+            [(name, labels, value) for (n, labels), value in counters if n == name],
+        )
+    for name in dict.fromkeys(name for (name, _), _ in gauges):
+        rows = [(labels, values) for (n, labels), values in gauges if n == name]
+        family(name, "gauge", [(name, labels, values[0]) for labels, values in rows])
+        family(
+            f"{name}_max",
+            "gauge",
+            [(f"{name}_max", labels, values[1]) for labels, values in rows],
+        )
+    return "\n".join(lines) + "\n"
+
+
+# Write the metrics to path, in the Prometheus text format for .prom files
+# and as JSON otherwise
+def write(path):
+    with open(path, "w") as file:
+        file.write(to_prometheus() if path.endswith(".prom") else to_json())
+
+
+# Sampling profiler for the threads of this process. A background thread
+# looks at every other thread's stack each interval seconds and counts the
+# stacks seen, so the cost is set by the interval rather than by how many
+# calls the profiled code makes. stacks() gives "file:function;..." strings
+# (outermost call first) with their sample counts, collapsed() the same as
+# text that flamegraph tools read.
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = {}
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_filename}:{code.co_name}")
+                    frame = frame.f_back
+                stack = ";".join(reversed(stack))
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def stacks(self):
+        # copied first, the sampling thread may still be adding stacks
+        samples = dict(self.samples)
+        return dict(sorted(samples.items(), key=lambda item: -item[1]))
+
+    def collapsed(self):
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks().items())
@@ -0,0 +1,325 @@
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from common import season_of_date
+
+GAMES_CSV = "games_2011_to_2023.csv"
+# Weights of WP, OWP and OOWP
+WEIGHTS = (0.25, 0.5, 0.25)
+# Columns of the <division>/legends/<year>.csv files, whose rpi column holds
+# the RPI rank shown on each team page
+LEGEND_COLS = [
+    "school_id",
+    "team_id",
+    "image_src",
+    "name",
+    "athletics_href",
+    "rpi",
+    "rpi_href",
+]
+RPI_COLS = ["games", "wins", "wp", "owp", "oowp", "rpi", "rank"]
+
+
+# Rank of each value from the highest, sharing the best rank on ties and
+# leaving missing values unranked
+def rank(values):
+    ranks = np.full(len(values), np.nan)
+    valid = ~np.isnan(values)
+    ordered = np.sort(-values[valid])
+    ranks[valid] = np.searchsorted(ordered, -values[valid], side="left") + 1
+    return ranks
+
+
+# Results of one season so far as sparse team x team matrices: wins[i, j]
+# counts the wins of team i over team j, with a tie as half a win for both,
+# and games[i, j] the games they played. Games are added a day (or any batch)
+# at a time and WP, OWP, OOWP and RPI can be read off after every batch.
+class RPI:
+    def __init__(self, teams=(), weights=WEIGHTS):
+        self.weights = weights
+        self.teams = []
+        self.team_index = {}
+        self.wins = sp.csr_matrix((0, 0))
+        self.games = sp.csr_matrix((0, 0))
+        self.add_teams(teams)
+
+    def add_teams(self, teams):
+        for team in teams:
+            if team not in self.team_index:
+                self.team_index[team] = len(self.teams)
+                self.teams.append(team)
+        n = len(self.teams)
+        if self.wins.shape != (n, n):
+            self.wins.resize((n, n))
+            self.games.resize((n, n))
+
+    def encode(self, teams):
+        return np.fromiter(
+            (self.team_index[team] for team in teams), dtype=np.int64, count=len(teams)
+        )
+
+    # Add games given as winners and losers, with ties marking tied games
+    def add_games(self, winners, losers, ties=None):
+        winners, losers = np.asarray(winners), np.asarray(losers)
+        self.add_teams(pd.unique(np.concatenate([winners, losers])))
+        w, l = self.encode(winners), self.encode(losers)
+        n = len(self.teams)
+        credit = np.ones(len(w))
+        if ties is not None:
+            credit[np.asarray(ties, dtype=bool)] = 0.5
+        rows, cols = np.concatenate([w, l]), np.concatenate([l, w])
+        self.wins = self.wins + sp.csr_matrix(
+            (np.concatenate([credit, 1 - credit]), (rows, cols)), shape=(n, n)
+        )
+        self.games = self.games + sp.csr_matrix(
+            (np.ones(len(rows)), (rows, cols)), shape=(n, n)
+        )
+
+    # WP, OWP, OOWP and RPI of every team as arrays. A team's OWP averages,
+    # over its games, each opponent's WP without the games against the team
+    # itself; OOWP averages its opponents' OWP the same way. Opponents with no
+    # other games are left out of OWP.
+    def values(self):
+        n = len(self.teams)
+        games_played = np.asarray(self.games.sum(axis=1)).ravel()
+        wins = np.asarray(self.wins.sum(axis=1)).ravel()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            wp = wins / games_played
+
+            games = self.games
+            games.sort_indices()
+            rows = np.repeat(np.arange(n), np.diff(games.indptr))
+            cols, g = games.indices, games.data
+            # Wins of j over i at the same entries. Adding them to the games
+            # (which are never 0 where there are wins) keeps the pattern of
+            # games, so the data lines up without indexing.
+            both = games + self.wins.T.tocsr()
+            both.sort_indices()
+            wins_ji = both.data - g
+            other_games = games_played[cols] - g
+            counted = other_games > 0
+            i, j = rows[counted], cols[counted]
+            opponent_wp = (wins[j] - wins_ji[counted]) / other_games[counted]
+            owp = np.bincount(i, g[counted] * opponent_wp, minlength=n) / np.bincount(
+                i, g[counted], minlength=n
+            )
+
+            rated = ~np.isnan(owp[cols])
+            i, j, g = rows[rated], cols[rated], g[rated]
+            oowp = np.bincount(i, g * owp[j], minlength=n) / np.bincount(
+                i, g, minlength=n
+            )
+        rpi = self.weights[0] * wp + self.weights[1] * owp + self.weights[2] * oowp
+        return {
+            "games": games_played,
+            "wins": wins,
+            "wp": wp,
+            "owp": owp,
+            "oowp": oowp,
+            "rpi": rpi,
+            "rank": rank(rpi),
+        }
+
+    def table(self):
+        return pd.DataFrame(self.values(), index=pd.Index(self.teams, name="team"))
+
+
+# Winner, loser, day and season of every game in a games frame, sorted by day.
+# With ties set, games with a margin of 0 are ties.
+def __prepare_games__(games, winner_col, loser_col, time_col, margin_col, ties):
+    days = pd.DatetimeIndex(games[time_col]).normalize()
+    order = np.argsort(days.asi8, kind="stable")
+    tied = np.zeros(len(games), dtype=bool)
+    if ties and margin_col is not None:
+        tied = games[margin_col].to_numpy(np.float64) == 0
+    return (
+        games[winner_col].to_numpy()[order],
+        games[loser_col].to_numpy()[order],
+        days[order],
+        season_of_date(days[order]).to_numpy(),
+        tied[order],
+    )
+
+
+# RPI of every team after every day with games, season by season, from a
+# games frame with one row per game (as ELO.from_frame takes, or an ELO
+# model's games_df). Each season's matrices are only added to, so a day costs
+# the games played on it plus one pass over the season's pairings.
+def daily_rpi(
+    games,
+    winner_col="winner",
+    loser_col="loser",
+    time_col="timestamp",
+    margin_col="margin",
+    ties=False,
+    weights=WEIGHTS,
+):
+    if margin_col not in games:
+        margin_col = None
+    winners, losers, days, seasons, tied = __prepare_games__(
+        games, winner_col, loser_col, time_col, margin_col, ties
+    )
+    columns = {column: [] for column in ["date", "season", "team"] + RPI_COLS}
+    for season in np.unique(seasons):
+        lo, hi = np.searchsorted(seasons, [season, season + 1])
+        rpi = RPI(weights=weights)
+        day_starts = np.flatnonzero(np.r_[True, days[lo + 1 : hi] != days[lo : hi - 1]])
+        bounds = np.append(day_starts, hi - lo) + lo
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            rpi.add_games(winners[start:stop], losers[start:stop], tied[start:stop])
+            values = rpi.values()
+            values["team"] = list(rpi.teams)
+            values["date"] = np.full(len(rpi.teams), days[start].asm8)
+            values["season"] = np.full(len(rpi.teams), season)
+            for column, value in values.items():
+                columns[column].append(value)
+    return pd.DataFrame(
+        {
+            column: np.concatenate(values) if values else []
+            for column, values in columns.items()
+        }
+    )
+
+
+# RPI table of the season a date falls in, from the games played up to and
+# including that date
+def rpi_as_of(
+    games,
+    date,
+    winner_col="winner",
+    loser_col="loser",
+    time_col="timestamp",
+    margin_col="margin",
+    ties=False,
+    weights=WEIGHTS,
+):
+    if margin_col not in games:
+        margin_col = None
+    winners, losers, days, seasons, tied = __prepare_games__(
+        games, winner_col, loser_col, time_col, margin_col, ties
+    )
+    date = pd.Timestamp(str(date))
+    played = (seasons == season_of_date([date])[0]) & (days <= date)
+    rpi = RPI(weights=weights)
+    rpi.add_games(winners[played], losers[played], tied[played])
+    return rpi.table()
+
+
+# Winner/loser rows from the cleaned games CSV (one row per team per game):
+# the winning side of every decided game and one side of every tie
+def load_games(games_csv=GAMES_CSV):
+    games = pd.read_csv(
+        games_csv,
+        usecols=["contest_id", "date", "result", "gs", "ga", "school_id"]
+        + ["opponent_school_id"],
+        parse_dates=["date"],
+    )
+    games = games.loc[games.result.isin(["W", "T"])].drop_duplicates("contest_id")
+    return pd.DataFrame(
+        {
+            "id": games.contest_id.to_numpy(),
+            "timestamp": games.date.to_numpy(),
+            "winner": games.school_id.to_numpy(),
+            "loser": games.opponent_school_id.to_numpy(),
+            "margin": (games.gs - games.ga).to_numpy(np.float64),
+        }
+    )
+
+
+def load_legends(path):
+    legends = pd.read_csv(path, header=None, names=LEGEND_COLS)
+    legends["rpi"] = pd.to_numeric(legends.rpi, errors="coerce")
+    return legends
+
+
+# Compare the final computed RPI ranks of a season with the scraped ranks of
+# a legends file (teams keyed by school id). Returns the joined ranks and the
+# share of exact matches, of ranks within 5 places and the rank correlation.
+def validate(daily, legends, season):
+    final = daily.loc[daily.season == season]
+    final = final.loc[final.date == final.date.max()]
+    ranks = legends[["school_id", "name", "rpi"]].merge(
+        final[["team", "rpi", "rank"]].rename(
+            columns={"team": "school_id", "rpi": "computed_rpi"}
+        ),
+        on="school_id",
+    )
+    ranks = ranks.rename(columns={"rpi": "scraped_rank", "rank": "computed_rank"})
+    ranks = ranks.dropna(subset=["scraped_rank"])
+    gap = (ranks.computed_rank - ranks.scraped_rank).abs()
+    summary = {
+        "teams": len(ranks),
+        "exact": float((gap == 0).mean()),
+        "within_5": float((gap <= 5).mean()),
+        "spearman": float(
+            ranks.computed_rank.corr(ranks.scraped_rank, method="spearman")
+        ),
+    }
+    return ranks.sort_values("scraped_rank"), summary
+
+
+# Latest RPI of every team on or before each date, taken from a daily_rpi
+# table and restricted to the season of the date
+def __rpi_before__(daily, teams, dates, allow_exact):
+    dates = pd.DatetimeIndex(dates).normalize()
+    left = pd.DataFrame(
+        {
+            "order": np.arange(len(dates)),
+            "date": dates,
+            "season": season_of_date(dates).to_numpy(),
+            "team": np.asarray(teams),
+        }
+    )
+    right = daily.astype({"season": left.season.dtype, "date": left.date.dtype})
+    found = pd.merge_asof(
+        left.sort_values("date"),
+        right.sort_values("date"),
+        on="date",
+        by=["season", "team"],
+        allow_exact_matches=allow_exact,
+    )
+    return found.sort_values("order")
+
+
+# ELO rating and RPI of every team as of a date (the end of the daily table
+# by default), for a fitted ELO model and a daily_rpi table of its games
+def ratings_with_rpi(elo, daily, date=None):
+    date = daily.date.max() if date is None else pd.Timestamp(str(date))
+    history = elo.history
+    ratings = history.lookup(
+        range(len(history.competitors)), [history.position_as_of(date)]
+    )[0]
+    rpi = __rpi_before__(
+        daily, history.competitors, [date] * len(history.competitors), True
+    )
+    frame = rpi.set_index("team")[RPI_COLS]
+    frame.insert(0, "elo", ratings)
+    return frame.sort_values("elo", ascending=False)
+
+
+# Pre-game features of every game of a fitted ELO model: its win probability
+# for the listed winner next to the RPI of both teams as of the day before
+def game_features(elo, daily):
+    games = elo.games_df
+    features = {"timestamp": games.timestamp.to_numpy()}
+    features["win_prob"] = games.win_prob.to_numpy()
+    for side in ["winner", "loser"]:
+        rpi = __rpi_before__(daily, games[side], games.timestamp, False)
+        for column in ["wp", "owp", "oowp", "rpi", "rank"]:
+            features[f"{side}_{column}"] = rpi[column].to_numpy()
+    return pd.DataFrame(features, index=games.index)
+
+
+if __name__ == "__main__":
+    games = load_games()
+    start = time.perf_counter()
+    daily = daily_rpi(games, ties=True)
+    print(
+        f"RPI after {daily.date.nunique()} days of {daily.season.nunique()} seasons "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+    latest = daily.loc[daily.date == daily.date.max()]
+    print(latest.sort_values("rank").head(25).to_string(index=False))
@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import time
+
+import scraping.lxml_parsing_functions as lpf
+from scraping.crawler import folders, parse_team_page
+from scraping.page_cache import PageCache
+
+# "lxml" is the single pass parse_team_page the crawler uses, and
+# "lxml_functions" runs the separate lxml parse_* functions one by one
+BACKENDS = ["bs4", "lxml", "lxml_functions"]
+LXML_FUNCTIONS = [
+    lpf.parse_team_legend,
+    lpf.parse_head_coaches,
+    lpf.parse_links,
+    lpf.parse_records,
+    lpf.parse_schedule,
+    lpf.parse_team_stats,
+    lpf.parse_venues,
+]
+
+
+# Cached team pages as (name, html, team_id). A directory of .html files
+# named by team id works as well as a PageCache directory.
+def load_pages(source):
+    if any(name.endswith(".html") for name in os.listdir(source)):
+        for name in sorted(os.listdir(source)):
+            if name.endswith(".html"):
+                with open(os.path.join(source, name)) as file:
+                    yield name[: -len(".html")], file.read(), name.split(".")[0]
+        return
+    cache = PageCache(source)
+    for meta in sorted(cache.entries(), key=lambda meta: meta["url"]):
+        team_id = meta["url"].rstrip("/").split("/")[-1]
+        yield cache.key(meta["url"]), cache.get(meta["url"]), team_id
+
+
+# Rows from every parser on a page, keyed by folder
+def parse_tables(html, team_id, backend):
+    if backend == "lxml_functions":
+        tree = lpf.parse_html(html)
+        tables = {}
+        for folder, function in zip(folders, LXML_FUNCTIONS):
+            try:
+                rows = function(tree, 0, team_id)
+            except Exception:
+                continue
+            if rows:
+                tables[folder] = rows
+        return tables
+    return {
+        folder: rows
+        for folder, rows in parse_team_page(html, 0, team_id, backend=backend)
+    }
+
+
+# Parse every page with each backend and compare the rows against golden
+# files holding the BeautifulSoup output, which are (re)written when update is
+# set. Returns the mismatching (page, folder, backend) triples, with folder and
+# backend None for a page that has no golden file, and pages/s per backend.
+def compare(source, golden_dir, update=False):
+    os.makedirs(golden_dir, exist_ok=True)
+    mismatches = []
+    seconds = dict.fromkeys(BACKENDS, 0.0)
+    n_pages = 0
+    for name, html, team_id in load_pages(source):
+        n_pages += 1
+        tables = {}
+        for backend in BACKENDS:
+            start = time.perf_counter()
+            tables[backend] = parse_tables(html, team_id, backend)
+            seconds[backend] += time.perf_counter() - start
+        # JSON turns the rows into plain lists, the same as reading the golden
+        # file back
+        tables = {backend: json.loads(json.dumps(t)) for backend, t in tables.items()}
+
+        path = os.path.join(golden_dir, name + ".json")
+        if update:
+            with open(path, "w") as file:
+                json.dump(tables["bs4"], file, indent=1)
+        elif not os.path.exists(path):
+            mismatches.append((name, None, None))
+            continue
+        with open(path) as file:
+            golden = json.load(file)
+        for backend in BACKENDS:
+            for folder in sorted(set(golden) | set(tables[backend])):
+                if golden.get(folder) != tables[backend].get(folder):
+                    mismatches.append((name, folder, backend))
+
+    rates = {backend: n_pages / max(seconds[backend], 1e-9) for backend in BACKENDS}
+    return mismatches, rates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the lxml parsers against golden BeautifulSoup output"
+    )
+    parser.add_argument(
+        "source",
+        nargs="?",
+        default="benchmarks/fixtures",
+        help="PageCache directory or folder of .html files",
+    )
+    parser.add_argument("--golden", default="scraping/golden")
+    parser.add_argument("--update", action="store_true")
+    args = parser.parse_args()
+
+    mismatches, rates = compare(args.source, args.golden, update=args.update)
+    for name, folder, backend in mismatches:
+        if folder is None:
+            print(f"No golden file for {name}, run with --update to write one")
+        else:
+            print(f"{backend} differs from golden on {folder} for {name}")
+    print(
+        ", ".join(f"{backend}: {rate:.1f} pages/s" for backend, rate in rates.items())
+    )
+    raise SystemExit(1 if mismatches else 0)
@@ -0,0 +1,114 @@
+import sqlite3
+import time
+
+import pandas as pd
+
+from scraping.page_cache import season_complete
+
+STATES = ("pending", "fetched", "parsed", "failed")
+
+
+# Persistent record of every team page a crawl has to visit. Each URL keeps
+# its state (pending -> fetched -> parsed, or failed), the number of fetch
+# attempts and the last status code, committed as soon as they change so a
+# crawl that dies partway through can pick up where it stopped.
+class CrawlManifest:
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                school_id INTEGER,
+                team_id INTEGER,
+                division TEXT,
+                year TEXT,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                status TEXT,
+                updated REAL
+            )""")
+
+    # Register team pages (as from merge_histories.team_urls). Pages already
+    # in the manifest keep their progress.
+    def add(self, teams):
+        rows = teams[["team_url", "school_id", "team_id", "division", "year"]]
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO pages (url, school_id, team_id, division, year) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                (url, int(school_id), int(team_id), division, str(year))
+                for url, school_id, team_id, division, year in rows.itertuples(
+                    index=False
+                )
+            ],
+        )
+
+    # Pages still to crawl, with the state they are in: everything not parsed
+    # yet, plus failed pages with fewer than max_attempts attempts when
+    # retry_failed is set and, when refresh is set, parsed pages of seasons
+    # that are not over and so may have changed. Pages that were fetched but
+    # never parsed are fetched again (from the cache when one is used).
+    def remaining(self, retry_failed=False, max_attempts=None, refresh=False):
+        query = (
+            "SELECT url AS team_url, school_id, team_id, division, year, state "
+            "FROM pages WHERE state IN ('pending', 'fetched')"
+        )
+        params = []
+        if retry_failed:
+            query += " OR (state = 'failed'"
+            if max_attempts is not None:
+                query += " AND attempts < ?"
+                params.append(max_attempts)
+            query += ")"
+        if refresh:
+            years = [
+                year
+                for (year,) in self.connection.execute(
+                    "SELECT DISTINCT year FROM pages WHERE state = 'parsed'"
+                )
+                if not season_complete(year)
+            ]
+            placeholders = ", ".join("?" * len(years))
+            query += f" OR (state = 'parsed' AND year IN ({placeholders}))"
+            params += years
+        return pd.read_sql_query(
+            query + " ORDER BY rowid", self.connection, params=params
+        )
+
+    def record_attempt(self, url, status):
+        self.connection.execute(
+            "UPDATE pages SET attempts = attempts + 1, status = ?, updated = ? "
+            "WHERE url = ?",
+            (str(status), time.time(), url),
+        )
+
+    def set_state(self, url, state):
+        assert state in STATES
+        self.connection.execute(
+            "UPDATE pages SET state = ?, updated = ? WHERE url = ?",
+            (state, time.time(), url),
+        )
+
+    def counts(self):
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(
+            self.connection.execute(
+                "SELECT state, COUNT(*) FROM pages GROUP BY state"
+            ).fetchall()
+        )
+        return counts
+
+    def to_frame(self):
+        return pd.read_sql_query(
+            "SELECT * FROM pages ORDER BY rowid", self.connection
+        ).set_index("url")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
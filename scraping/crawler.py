@@ -0,0 +1,517 @@
+import asyncio
+import csv
+import json
+import functools
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+from bs4 import BeautifulSoup
+
+import metrics
+from cleaning.merge_histories import merge_histories, team_urls
+import scraping.lxml_parsing_functions as lpf
+import scraping.parsing_functions as pf
+from scraping.crawl_manifest import CrawlManifest
+from scraping.page_cache import PageCache, season_complete
+
+folders = [
+    "legends",
+    "coaches",
+    "links",
+    "records",
+    "schedules",
+    "team_page_stats",
+    "venues",
+]
+parsing_functions = [
+    pf.parse_team_legend,
+    pf.parse_head_coaches,
+    pf.parse_links,
+    pf.parse_records,
+    pf.parse_schedule,
+    pf.parse_team_stats,
+    pf.parse_venues,
+]
+
+
+# Token bucket limiting requests to rate per second with bursts of up to
+# capacity requests. Starts full and refills continuously.
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Counts of pages and rows through each stage of a crawl
+class CrawlStats:
+    def __init__(self):
+        self.fetched = 0
+        self.failed = 0
+        self.cache_hits = 0
+        self.not_modified = 0
+        self.retries = 0
+        self.parsed = 0
+        self.parse_failed = 0
+        self.parse_started = None
+        self.parse_finished = None
+        self.rows_written = 0
+        self.started = time.monotonic()
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        return (
+            f"fetched {self.fetched} pages ({self.failed} failed, "
+            f"{self.cache_hits} from cache, {self.not_modified} not modified, "
+            f"{self.retries} retries), parsed {self.parsed} "
+            f"({self.parse_failed} failed), wrote {self.rows_written} rows in "
+            f"{elapsed:.1f}s "
+            f"({self.fetched / max(elapsed, 1e-9):.2f} pages/s fetched, "
+            f"{self.parse_rate():.2f} pages/s parsed)"
+        )
+
+    # Pages parsed per second while the parse stage had work, so a slow
+    # fetch stage does not hide how fast the pool parses
+    def parse_rate(self):
+        if self.parse_started is None:
+            return 0.0
+        return self.parsed / max(self.parse_finished - self.parse_started, 1e-9)
+
+
+# Run every parser on one team page and return (folder, rows) pairs. Runs in
+# the parse pool, so the soup is built once per page and only plain rows are
+# sent back to the event loop. backend="lxml" uses the single pass
+# lxml_parsing_functions.parse_team_page, which gives the same rows as the
+# BeautifulSoup parsers in a fraction of the time. Building the soup and each
+# parser are timed under parse_stage_seconds.
+def parse_team_page(html, school_id, team_id, backend="bs4"):
+    if backend == "lxml":
+        page = lpf.parse_team_page(html, school_id, team_id)
+        for folder, e in page.errors.items():
+            print(f"Error parsing {folder} for {team_id}: {e}")
+        return page.tables()
+
+    with metrics.timer("parse_stage_seconds", backend="bs4", stage="tree"):
+        soup = BeautifulSoup(html, "lxml")
+    tables = []
+    for folder, function in zip(folders, parsing_functions):
+        try:
+            with metrics.timer("parse_stage_seconds", backend="bs4", stage=folder):
+                rows = function(soup, school_id, team_id)
+        except Exception as e:
+            print(f"Error parsing {folder} for {team_id}: {e}")
+            metrics.count("parse_errors_total", backend="bs4", stage=folder)
+            continue
+        if rows:
+            tables.append((folder, rows))
+    return tables
+
+
+# Throttling and server errors are worth retrying, as are dropped connections
+# (reported as the exception repr instead of a status code)
+def retryable(status):
+    return isinstance(status, str) or status == 429 or status >= 500
+
+
+# Metrics label of a fetch status. Dropped connections are "error" rather
+# than their exception repr, to keep the label values few.
+def status_label(status):
+    if isinstance(status, str) and status not in ("cached", "not cached"):
+        return "error"
+    return str(status)
+
+
+# Seconds to wait before retry number attempt + 1: exponential backoff with
+# full jitter, but never less than the server's Retry-After
+def backoff_delay(attempt, backoff, retry_after=None):
+    delay = random.uniform(0, backoff * 2**attempt)
+    try:
+        delay = max(delay, float(retry_after))
+    except (TypeError, ValueError):
+        pass
+    return delay
+
+
+# Get one team page, from the cache when it holds a fresh copy. Stale pages
+# are revalidated with a conditional request and a 304 reuses the cached
+# HTML. Offline, only the cache is consulted. Throttled and failed requests
+# are retried up to max_retries times, with every attempt recorded in the
+# manifest. Returns (status, html, retries) where status is "cached" for
+# pages served without a request.
+async def fetch_page(
+    session,
+    bucket,
+    team,
+    headers=None,
+    cache=None,
+    offline=False,
+    manifest=None,
+    max_retries=5,
+    backoff=1.0,
+):
+    url = team["team_url"]
+    if cache is not None and (offline or cache.is_fresh(url)):
+        with metrics.timer("crawl_cache_read_seconds"):
+            html = cache.get(url)
+        if html is not None:
+            return "cached", html, 0
+    if offline:
+        return "not cached", None, 0
+
+    request_headers = dict(headers or {})
+    if cache is not None:
+        request_headers.update(cache.conditional_headers(url))
+    for attempt in range(max_retries + 1):
+        with metrics.timer("crawl_rate_limit_wait_seconds"):
+            await bucket.acquire()
+        start = time.perf_counter()
+        try:
+            async with session.get(url, headers=request_headers) as response:
+                # Bytes that are not valid under the declared charset are
+                # replaced rather than failing the page
+                html = await response.text(errors="replace")
+                status = response.status
+                response_headers = response.headers
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            html, status, response_headers = None, repr(e), {}
+        metrics.observe(
+            "crawl_fetch_seconds",
+            time.perf_counter() - start,
+            status=status_label(status),
+        )
+        if manifest is not None:
+            manifest.record_attempt(url, status)
+        if not retryable(status) or attempt == max_retries:
+            break
+        await asyncio.sleep(
+            backoff_delay(attempt, backoff, response_headers.get("Retry-After"))
+        )
+
+    if cache is not None:
+        immutable = season_complete(team["year"])
+        if status == 304:
+            cache.touch(url, immutable=immutable)
+            html = cache.get(url)
+        elif status == 200:
+            cache.put(
+                url,
+                html,
+                etag=response_headers.get("ETag"),
+                last_modified=response_headers.get("Last-Modified"),
+                immutable=immutable,
+            )
+    return status, html, attempt
+
+
+# Fetch pages from url_queue onto page_queue. A page whose fetch raises is
+# recorded as a failed attempt, so one bad page can not stop the crawl.
+async def fetch_worker(fetch, url_queue, page_queue, stats, manifest=None):
+    while True:
+        team = await url_queue.get()
+        metrics.gauge("crawl_queue_depth", url_queue.qsize(), queue="urls")
+        if team is None:
+            url_queue.task_done()
+            return
+        try:
+            status, html, retries = await fetch(team)
+        except Exception as e:
+            status, html, retries = repr(e), None, 0
+            if manifest is not None:
+                manifest.record_attempt(team["team_url"], status)
+        stats.retries += retries
+        metrics.count("crawl_pages_total", status=status_label(status))
+        metrics.count("crawl_retries_total", retries)
+        if status in ("cached", 200, 304):
+            stats.fetched += 1
+            stats.cache_hits += status == "cached"
+            stats.not_modified += status == 304
+            # A parsed page being refreshed stays parsed until its new rows
+            # are written, so a crawl that stops before then refreshes it again
+            if manifest is not None and team.get("state") != "parsed":
+                manifest.set_state(team["team_url"], "fetched")
+            await page_queue.put((team, html))
+        else:
+            stats.failed += 1
+            if manifest is not None:
+                manifest.set_state(team["team_url"], "failed")
+            print(f"Failed to fetch {team['team_url']}: {status}")
+        url_queue.task_done()
+
+
+# Hand pages to the process pool so that parsing never blocks the event loop
+async def parse_worker(
+    pool, page_queue, write_queues, stats, manifest=None, backend="bs4"
+):
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await page_queue.get()
+        metrics.gauge("crawl_queue_depth", page_queue.qsize(), queue="pages")
+        if item is None:
+            page_queue.task_done()
+            return
+        team, html = item
+        if stats.parse_started is None:
+            stats.parse_started = time.monotonic()
+        args = (html, team["school_id"], team["team_id"], backend)
+        start = time.perf_counter()
+        # A page the pool fails on (including a broken pool) is marked failed
+        # and skipped, so the rest of the crawl still gets written
+        try:
+            if metrics.enabled():
+                # The pool processes keep no metrics of their own, so the
+                # parse timings come back with the tables
+                tables, parse_metrics = await loop.run_in_executor(
+                    pool, metrics.measured, parse_team_page, *args
+                )
+                metrics.merge(parse_metrics)
+            else:
+                tables = await loop.run_in_executor(pool, parse_team_page, *args)
+        except Exception as e:
+            print(f"Failed to parse {team['team_url']}: {e!r}")
+            stats.parse_failed += 1
+            stats.parse_finished = time.monotonic()
+            metrics.count("crawl_parse_failures_total")
+            if manifest is not None:
+                manifest.set_state(team["team_url"], "failed")
+            page_queue.task_done()
+            continue
+        metrics.observe(
+            "crawl_parse_page_seconds", time.perf_counter() - start, backend=backend
+        )
+        stats.parse_finished = time.monotonic()
+        on_written = page_written(team["team_url"], len(tables), manifest)
+        resumed = team.get("state") == "fetched"
+        for folder, rows in tables:
+            await write_queues[folder].put(
+                (team["division"], team["year"], rows, resumed, on_written)
+            )
+        stats.parsed += 1
+        page_queue.task_done()
+
+
+# Callback for the writers that marks a page parsed in the manifest once the
+# last of its n_tables tables is on disk
+def page_written(url, n_tables, manifest):
+    remaining = [n_tables]
+
+    def on_written():
+        remaining[0] -= 1
+        if remaining[0] <= 0 and manifest is not None:
+            manifest.set_state(url, "parsed")
+
+    if n_tables == 0:
+        on_written()
+    return on_written
+
+
+# Pages (school_id, team_id as written) a table CSV already holds. A crawl
+# that died mid-write can leave a partial last line, which is cut off first so
+# appended rows start on a line of their own.
+def written_pages(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as file:
+        content = file.read()
+        if content and not content.endswith(b"\n"):
+            file.truncate(content.rfind(b"\n") + 1)
+    with open(path, newline="") as file:
+        return {tuple(row[:2]) for row in csv.reader(file) if len(row) >= 2}
+
+
+# Rewrite a table CSV with the rows of some pages, keyed by (school_id,
+# team_id) as written, swapped for new ones. Goes through a temporary file so
+# the table is never left half written.
+def replace_pages(path, page_rows):
+    with open(path, newline="") as file:
+        rows = [row for row in csv.reader(file) if tuple(row[:2]) not in page_rows]
+    with open(path + ".tmp", "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerows(rows)
+        for new_rows in page_rows.values():
+            writer.writerows(new_rows)
+    os.replace(path + ".tmp", path)
+
+
+# Append rows for one table to <out_dir>/<division>/<folder>/<year>.csv,
+# keeping one open file per division and season. Every row starts with the
+# page's school_id and team_id. When the file already has rows for a page,
+# they are kept for a resumed page (one fetched by a crawl that stopped before
+# marking it parsed, so the rows are its own) and replaced otherwise, as for a
+# refreshed page of a season still in progress. Replacements are made once
+# the table is done, with one rewrite per file, and only then are their pages
+# marked parsed.
+async def write_worker(folder, write_queue, out_dir, stats):
+    files, writers, pages = {}, {}, {}
+    # (division, year) -> {page: new rows}, and the callbacks of those pages
+    replaced, replaced_written = {}, []
+    try:
+        while True:
+            item = await write_queue.get()
+            metrics.gauge("crawl_queue_depth", write_queue.qsize(), queue=folder)
+            if item is None:
+                for (division, year), page_rows in replaced.items():
+                    files[division, year].close()
+                    path = os.path.join(out_dir, division, folder, year + ".csv")
+                    with metrics.timer("crawl_write_seconds", table=folder):
+                        replace_pages(path, page_rows)
+                    n_rows = sum(len(rows) for rows in page_rows.values())
+                    stats.rows_written += n_rows
+                    metrics.count("crawl_rows_written_total", n_rows, table=folder)
+                for on_written in replaced_written:
+                    on_written()
+                write_queue.task_done()
+                return
+            division, year, rows, resumed, on_written = item
+            if (division, year) not in writers:
+                path = os.path.join(out_dir, division, folder, year + ".csv")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                pages[division, year] = written_pages(path)
+                files[division, year] = open(path, "a", newline="")
+                writers[division, year] = csv.writer(files[division, year])
+            page = (str(rows[0][0]), str(rows[0][1]))
+            if page not in pages[division, year]:
+                with metrics.timer("crawl_write_seconds", table=folder):
+                    writers[division, year].writerows(rows)
+                    files[division, year].flush()
+                pages[division, year].add(page)
+                stats.rows_written += len(rows)
+                metrics.count("crawl_rows_written_total", len(rows), table=folder)
+                on_written()
+            elif resumed:
+                metrics.count("crawl_rows_skipped_total", len(rows), table=folder)
+                on_written()
+            else:
+                replaced.setdefault((division, year), {})[page] = rows
+                replaced_written.append(on_written)
+            write_queue.task_done()
+    finally:
+        for file in files.values():
+            file.close()
+
+
+# Crawl team pages with a shared session. Fetches are limited to
+# requests_per_second and max_concurrency in flight, pages flow through a
+# bounded queue to parser workers, and parsed rows go to one CSV writer per
+# table so that slow stages apply backpressure instead of buffering pages.
+# Parsing runs in a pool of parser_workers processes (one per core by default)
+# with the given parser backend ("bs4" or "lxml").
+# With a PageCache, fetched pages are kept on disk and only refetched once
+# stale; offline=True parses from the cache alone without any requests.
+# With a CrawlManifest, teams are added to it and only pages that have not
+# been parsed yet are crawled, so a restarted crawl resumes where it stopped.
+# refresh also crawls parsed pages of seasons still in progress again and
+# replaces their rows.
+async def crawl(
+    teams,
+    out_dir=".",
+    headers=None,
+    requests_per_second=4,
+    max_concurrency=8,
+    parser_workers=None,
+    queue_size=64,
+    cache=None,
+    offline=False,
+    manifest=None,
+    retry_failed=False,
+    max_retries=5,
+    backoff=1.0,
+    backend="bs4",
+    refresh=False,
+):
+    assert cache is not None or not offline
+    if manifest is not None:
+        manifest.add(teams)
+        teams = manifest.remaining(retry_failed=retry_failed, refresh=refresh)
+    parser_workers = parser_workers or os.cpu_count()
+    stats = CrawlStats()
+    bucket = TokenBucket(requests_per_second, capacity=max(1, max_concurrency // 2))
+    url_queue = asyncio.Queue(maxsize=queue_size)
+    page_queue = asyncio.Queue(maxsize=queue_size)
+    write_queues = {folder: asyncio.Queue(maxsize=queue_size) for folder in folders}
+
+    writers = [
+        asyncio.create_task(write_worker(folder, queue, out_dir, stats))
+        for folder, queue in write_queues.items()
+    ]
+    pool = ProcessPoolExecutor(max_workers=parser_workers)
+    parsers = [
+        asyncio.create_task(
+            parse_worker(pool, page_queue, write_queues, stats, manifest, backend)
+        )
+        for _ in range(parser_workers)
+    ]
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        fetch = functools.partial(
+            fetch_page,
+            session,
+            bucket,
+            headers=headers,
+            cache=cache,
+            offline=offline,
+            manifest=manifest,
+            max_retries=max_retries,
+            backoff=backoff,
+        )
+        fetchers = [
+            asyncio.create_task(
+                fetch_worker(fetch, url_queue, page_queue, stats, manifest)
+            )
+            for _ in range(max_concurrency)
+        ]
+        for team in teams.to_dict("records"):
+            await url_queue.put(team)
+        for _ in fetchers:
+            await url_queue.put(None)
+        await asyncio.gather(*fetchers)
+
+    # Shut the pipeline down stage by stage
+    for _ in parsers:
+        await page_queue.put(None)
+    await asyncio.gather(*parsers)
+    pool.shutdown()
+    for queue in write_queues.values():
+        await queue.put(None)
+    await asyncio.gather(*writers)
+    print(stats.summary())
+    return stats
+
+
+if __name__ == "__main__":
+    metrics.enable()
+    HEADERS = json.load(open("scraping/headers.json"))
+    merge_histories()
+    teams = team_urls()
+    cache = PageCache("html_cache", max_age=24 * 60 * 60)
+    with CrawlManifest("crawl_manifest.sqlite") as manifest:
+        asyncio.run(
+            crawl(
+                teams,
+                out_dir=".",
+                headers=HEADERS,
+                cache=cache,
+                manifest=manifest,
+                retry_failed=True,
+                refresh=True,
+            )
+        )
+        print(manifest.counts())
+    metrics.write("crawl_metrics.prom")
@@ -0,0 +1,584 @@
+import re
+from collections import namedtuple
+
+from lxml import etree
+
+import metrics
+
+# Same parsers as parsing_functions, but on an lxml tree with precompiled
+# XPath selectors. Each function returns exactly the rows its BeautifulSoup
+# counterpart does; the helpers below reproduce the BeautifulSoup lookups
+# (.string, .next_sibling, str(tag)) the originals rely on.
+
+
+def has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+FIRST_FIELDSET = etree.XPath("(//fieldset)[1]")
+FIRST_IMG = etree.XPath("descendant::img[1]")
+FIRST_A = etree.XPath("descendant::a[1]")
+FIRST_TD = etree.XPath("descendant::td[1]")
+FIRST_BR = etree.XPath("descendant::br[1]")
+FIRST_LEGEND = etree.XPath("descendant::legend[1]")
+FIRST_TBODY = etree.XPath("descendant::tbody[1]")
+NEXT_A = etree.XPath("following-sibling::a[1]")
+NEXT_TABLE = etree.XPath("following-sibling::table[1]")
+NEXT_FIELDSETS = etree.XPath("following-sibling::fieldset")
+NEXT_TR = etree.XPath("(descendant::tr | following::tr)[1]")
+NEXT_TRS = etree.XPath("following-sibling::tr")
+ALL_A = etree.XPath("//a")
+LEGENDS = etree.XPath("//legend")
+TDS = etree.XPath("descendant::td")
+TRS = etree.XPath("descendant::tr")
+DIVS = etree.XPath("descendant::div")
+LABELS = etree.XPath("descendant::label")
+FIELDSETS = etree.XPath("descendant::fieldset")
+FACILITY_DIV = etree.XPath("(//div[@id='facility_div'])[1]")
+HEAD_COACHES_DIV = etree.XPath("(//div[@id='head_coaches_div'])[1]")
+MYTABLE = etree.XPath(f"(//table[{has_class('mytable')}])[1]")
+HEADING_TR = etree.XPath(f"descendant::tr[{has_class('heading')}][1]")
+SCHEDULE_TD = etree.XPath("//td")
+TEXT = etree.XPath("string()")
+
+VENUE_LABELS = ["Name", "Capacity", "Year Built", "Primary Venue"]
+COACH_FIELDS = ["Alma mater", "Start date", "End date", "Seasons", "Record"]
+LINK_LABELS = ["Roster", "Team Statistics", "Game By Game", "Ranking Summary"]
+RECORDS_LEGEND = "Season-to-date"
+SCHEDULE_LABEL = "Schedule/Results"
+
+
+# Pages are parsed from UTF-8 bytes, since lxml refuses a str that carries an
+# XML encoding declaration. An empty or whitespace-only page has no root and
+# is parsed as an empty <html> element.
+def parse_html(html):
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    root = etree.fromstring(html, etree.HTMLParser(encoding="utf-8"))
+    return etree.Element("html") if root is None else root
+
+
+# Child nodes of an element in order, text as str and tags as elements
+def child_nodes(element):
+    nodes = [element.text] if element.text is not None else []
+    for child in element:
+        nodes.append(child)
+        if child.tail is not None:
+            nodes.append(child.tail)
+    return nodes
+
+
+# BeautifulSoup's .string: the only string inside a chain of single children
+def string(node):
+    while node is not None and not isinstance(node, str):
+        if isinstance(node, etree._Comment):
+            return node.text
+        # Most nodes are a tag around plain text
+        if len(node) == 0:
+            return node.text
+        nodes = child_nodes(node)
+        node = nodes[0] if len(nodes) == 1 else None
+    return node
+
+
+# BeautifulSoup's .next_sibling: the element's tail text or the next node
+def next_sibling(element):
+    if element.tail is not None:
+        return element.tail
+    return element.getnext()
+
+
+# str() of a BeautifulSoup node
+def node_str(node):
+    if node is None or isinstance(node, str):
+        return str(node)
+    return etree.tostring(node, method="html", encoding=str, with_tail=False)
+
+
+def first(matches):
+    return matches[0] if matches else None
+
+
+# Text following a label, which BeautifulSoup exposes as label.next_sibling
+def label_value(label):
+    value = next_sibling(label)
+    assert isinstance(value, str)
+    return value.strip()
+
+
+# Rows of each table as named records, in the column order the CSVs use
+LegendRow = namedtuple(
+    "LegendRow",
+    ["school_id", "team_id", "image_src", "name", "athletics_url", "rpi", "rpi_url"],
+)
+CoachRow = namedtuple(
+    "CoachRow",
+    [
+        "school_id",
+        "team_id",
+        "name",
+        "coach_url",
+        "alma_mater",
+        "start_date",
+        "end_date",
+        "seasons",
+        "record",
+    ],
+)
+LinkRow = namedtuple(
+    "LinkRow",
+    [
+        "school_id",
+        "team_id",
+        "roster_url",
+        "team_stats_url",
+        "game_by_game_url",
+        "ranking_summary_url",
+    ],
+)
+RecordRow = namedtuple(
+    "RecordRow", ["school_id", "team_id", "category", "record", "win_pct", "streak"]
+)
+ScheduleRow = namedtuple(
+    "ScheduleRow",
+    [
+        "school_id",
+        "team_id",
+        "date",
+        "site",
+        "opponent",
+        "opponent_url",
+        "notes",
+        "opponent_img_url",
+        "result",
+        "contest_url",
+        "attendance",
+    ],
+)
+TeamStatRow = namedtuple(
+    "TeamStatRow", ["school_id", "team_id", "stat", "stat_url", "rank", "value"]
+)
+VenueRow = namedtuple(
+    "VenueRow",
+    ["school_id", "team_id", "name", "capacity", "year_built", "primary_venue"],
+)
+
+
+# Everything parsed from one team page. Each table is a list of rows, or None
+# when the page does not have it or its extractor failed; errors maps the
+# failed tables to their exception.
+class TeamPage(
+    namedtuple(
+        "TeamPage",
+        [
+            "legends",
+            "coaches",
+            "links",
+            "records",
+            "schedules",
+            "team_page_stats",
+            "venues",
+            "errors",
+        ],
+    )
+):
+    __slots__ = ()
+
+    # (folder, rows) for every table with rows, as the crawler writes them
+    def tables(self):
+        return [
+            (folder, rows) for folder, rows in zip(self._fields[:-1], self[:-1]) if rows
+        ]
+
+
+# Parse the title row at the top of the page from the first fieldset
+def extract_team_legend(fieldset, school_id, team_id):
+    legend = FIRST_LEGEND(fieldset)[0]
+    img = FIRST_IMG(legend)[0]
+    name = None
+    athletics_href = None
+    image_src = img.attrib["src"]
+    # Deal with potential for no link on team name
+    possible_name = node_str(next_sibling(img)).strip()
+    if possible_name:
+        name = possible_name
+        rpi_link = first(NEXT_A(img))
+    else:
+        name_element = img.getnext()
+        name = str(string(name_element)).strip()
+        athletics_href = name_element.attrib["href"]
+        rpi_link = first(NEXT_A(name_element))
+    if "(" in name:
+        name = name.split("(")[0].strip()
+    rpi = None
+    rpi_href = None
+    if rpi_link is not None:
+        rpi = TEXT(rpi_link).split()[-1]
+        rpi_href = rpi_link.attrib["href"]
+    return [
+        LegendRow(school_id, team_id, image_src, name, athletics_href, rpi, rpi_href)
+    ]
+
+
+def parse_team_legend(tree, school_id, team_id):
+    return extract_team_legend(FIRST_FIELDSET(tree)[0], school_id, team_id)
+
+
+# Parse the venue information on the team page, finding every label in a
+# single pass over the venue's labels
+def parse_venue(venue_div, school_id, team_id):
+    found = {}
+    unlabelled = None
+    for i, label in enumerate(LABELS(venue_div)):
+        text = string(label)
+        if text is None:
+            unlabelled = i if unlabelled is None else unlabelled
+            continue
+        text = text.strip()
+        if text in VENUE_LABELS and text not in found:
+            found[text] = (i, label)
+    # BeautifulSoup fails on a label without a single string if it comes
+    # before a label still being searched for, so fail the same way
+    if unlabelled is not None and (
+        len(found) < len(VENUE_LABELS) or unlabelled < max(i for i, _ in found.values())
+    ):
+        raise AttributeError("label without a string in venue")
+    found = {text: label for text, (_, label) in found.items()}
+
+    name = label_value(found["Name"])
+    capacity = label_value(found["Capacity"])
+    year_built = label_value(found["Year Built"])
+    primary_venue = None
+
+    if "Primary Venue" in found:
+        primary_venue = label_value(found["Primary Venue"])
+
+    return VenueRow(school_id, team_id, name, capacity, year_built, primary_venue)
+
+
+# Parse all venues inside the facility_div
+def extract_venues(venues_div, school_id, team_id):
+    if venues_div is None:
+        return None
+    venues = []
+    for venue_div in DIVS(venues_div):
+        if "team_page_season_venue" in venue_div.attrib["id"]:
+            venues.append(parse_venue(venue_div, school_id, team_id))
+    return venues
+
+
+def parse_venues(tree, school_id, team_id):
+    return extract_venues(first(FACILITY_DIV(tree)), school_id, team_id)
+
+
+# Parse the head coach information on the team page
+def parse_head_coach(head_coach_fieldset, school_id, team_id):
+    name_a = FIRST_A(head_coach_fieldset)[0]
+    contents = [school_id, team_id, str(string(name_a)).strip(), name_a.attrib["href"]]
+    found = {}
+    for label in LABELS(head_coach_fieldset):
+        text = str(string(label))
+        for field in COACH_FIELDS:
+            if field not in found and field in text:
+                found[field] = label
+    for field in COACH_FIELDS:
+        if field in found:
+            contents.append(label_value(found[field]))
+        else:
+            contents.append(None)
+
+    return CoachRow(*contents)
+
+
+# Parse all coaches inside the head_coaches_div
+def extract_head_coaches(head_coaches_div, school_id, team_id):
+    if head_coaches_div is None:
+        return None
+    return [
+        parse_head_coach(fieldset, school_id, team_id)
+        for fieldset in FIELDSETS(head_coaches_div)
+    ]
+
+
+def parse_head_coaches(tree, school_id, team_id):
+    return extract_head_coaches(first(HEAD_COACHES_DIV(tree)), school_id, team_id)
+
+
+# Parse the record boxes following the "Season-to-date" legend
+def extract_records(season_records_legend, school_id, team_id):
+    if season_records_legend is None:
+        return None
+    record_rows = []
+    for fieldset in NEXT_FIELDSETS(season_records_legend):
+        legend = FIRST_LEGEND(fieldset)[0]
+        legend_text = str(string(legend)).strip()
+        record_line = node_str(next_sibling(legend)).strip().split()
+        record = record_line[0]
+        win_pct = re.sub(r"[()]", "", record_line[1])
+        br = FIRST_BR(fieldset)[0]
+        streak_line = node_str(next_sibling(br)).strip().split()
+        streak = streak_line[1]
+        record_rows.append(
+            RecordRow(school_id, team_id, legend_text, record, win_pct, streak)
+        )
+    return record_rows
+
+
+def parse_records(tree, school_id, team_id):
+    for legend in LEGENDS(tree):
+        if RECORDS_LEGEND in str(string(legend)):
+            return extract_records(legend, school_id, team_id)
+    return None
+
+
+# Record a as the link for every label in its text not matched yet
+def match_link(links, a):
+    text = str(string(a))
+    for label in LINK_LABELS:
+        if label not in links and label in text:
+            links[label] = a
+
+
+# Build the links row from the first anchor found for each label
+def extract_links(links, school_id, team_id):
+    if not links:
+        return None
+    hrefs = [
+        links[label].attrib["href"] if label in links else None for label in LINK_LABELS
+    ]
+    return [LinkRow(school_id, team_id, *hrefs)]
+
+
+# Parse the links on the team page in one pass over the anchors
+def parse_links(tree, school_id, team_id):
+    links = {}
+    for a in ALL_A(tree):
+        match_link(links, a)
+        if len(links) == len(LINK_LABELS):
+            break
+    return extract_links(links, school_id, team_id)
+
+
+def parse_new_schedule(schedule_results_legend, school_id, team_id):
+    schedule_table = NEXT_TABLE(schedule_results_legend)[0]
+    schedule_table_body = FIRST_TBODY(schedule_table)[0]
+    schedule_rows = []
+    for tr in TRS(schedule_table_body):
+        tds = TDS(tr)
+        # skip border rows
+        if len(tds) != 4:
+            continue
+        # Get details like "@" or stuff about championships
+        opponent_nodes = child_nodes(tds[1])
+        before_details = node_str(opponent_nodes[0]).strip()
+        after_details = node_str(opponent_nodes[-1]).strip()
+        date = str(string(tds[0])).strip()
+        # The opponent cell is never itself a link, as in parse_new_schedule
+        opponent = None
+        opponent_href = None
+        opponent_img_src = None
+        opponent_field = str(string(tds[1])).strip()
+        if len(opponent_field) > 0 and opponent_field[0] == "@":
+            before_details = "@"
+            after_details = ""
+        result = None
+        result_href = None
+        result_link = first(FIRST_A(tds[2]))
+        if result_link is not None:
+            result_href = result_link.attrib["href"]
+            result = str(string(result_link)).strip()
+        elif string(tds[2]):
+            result = string(tds[2]).strip()
+        attendance = str(string(tds[3])).strip()
+        schedule_rows.append(
+            ScheduleRow(
+                school_id,
+                team_id,
+                date,
+                before_details,
+                opponent,
+                opponent_href,
+                after_details,
+                opponent_img_src,
+                result,
+                result_href,
+                attendance,
+            )
+        )
+    return schedule_rows
+
+
+def parse_old_schedule(schedule_result_td, school_id, team_id):
+    heading = NEXT_TR(schedule_result_td)[0]
+    schedule_rows = []
+    for tr in NEXT_TRS(heading):
+        tds = TDS(tr)
+        date = string(tds[0]).strip()
+        opponent_link = first(FIRST_A(tds[1]))
+        opponent_href = None
+        if opponent_link is not None:
+            opponent_href = opponent_link.attrib["href"]
+            opponent = string(opponent_link).strip()
+        else:
+            opponent = string(tds[1]).strip()
+        result_link = first(FIRST_A(tds[2]))
+        result_href = None
+        if result_link is not None:
+            result_href = result_link.attrib["href"]
+            result = string(result_link).strip()
+        else:
+            result = string(tds[2]).strip()
+        schedule_rows.append(
+            ScheduleRow(
+                school_id,
+                team_id,
+                date,
+                None,
+                opponent,
+                opponent_href,
+                None,
+                None,
+                result,
+                result_href,
+                None,
+            )
+        )
+    return schedule_rows
+
+
+# Parse the schedule from the "Schedule/Results" legend of the current page
+# layout, falling back to the table cell used by older seasons
+def extract_schedule(schedule_results_legend, schedule_result_td, school_id, team_id):
+    if schedule_results_legend is not None:
+        return parse_new_schedule(schedule_results_legend, school_id, team_id)
+    if schedule_result_td is not None:
+        return parse_old_schedule(schedule_result_td, school_id, team_id)
+
+
+def parse_schedule(tree, school_id, team_id):
+    for legend in LEGENDS(tree):
+        if SCHEDULE_LABEL in str(string(legend)):
+            return parse_new_schedule(legend, school_id, team_id)
+
+    for td in SCHEDULE_TD(tree):
+        if SCHEDULE_LABEL in str(string(td)):
+            return parse_old_schedule(td, school_id, team_id)
+
+
+# Parse the first table.mytable, unless it is an old layout schedule
+def extract_team_stats(team_stats_table, school_id, team_id):
+    if team_stats_table is None:
+        return None
+    team_stats_rows = []
+    heading_tr = HEADING_TR(team_stats_table)[0]
+    heading_td = first(FIRST_TD(heading_tr))
+    if heading_td is not None and TEXT(heading_td).strip() == SCHEDULE_LABEL:
+        return None
+    for tr in TRS(team_stats_table):
+        # skip header rows
+        if "class" in tr.attrib:
+            continue
+        tds = TDS(tr)
+        row_link = FIRST_A(tds[0])[0]
+        row_label = str(string(row_link)).strip()
+        row_href = row_link.attrib["href"]
+        row_rank = str(string(tds[1])).strip()
+        row_value = str(string(tds[2])).strip()
+        team_stats_rows.append(
+            TeamStatRow(school_id, team_id, row_label, row_href, row_rank, row_value)
+        )
+    return team_stats_rows
+
+
+def parse_team_stats(tree, school_id, team_id):
+    return extract_team_stats(first(MYTABLE(tree)), school_id, team_id)
+
+
+# Locate every node the extractors start from in a single walk over the
+# document: the first fieldset, facility_div, head_coaches_div, the
+# "Season-to-date" and "Schedule/Results" legends (or the old layout's
+# "Schedule/Results" cell), the first table.mytable and the first link for
+# each of LINK_LABELS
+def find_anchors(tree):
+    anchors = dict.fromkeys(
+        [
+            "fieldset",
+            "facility_div",
+            "head_coaches_div",
+            "records_legend",
+            "schedule_legend",
+            "schedule_td",
+            "mytable",
+        ]
+    )
+    links = {}
+    for element in tree.iter("fieldset", "div", "legend", "td", "table", "a"):
+        tag = element.tag
+        if tag == "a":
+            if len(links) < len(LINK_LABELS):
+                match_link(links, element)
+        elif tag == "td":
+            if anchors["schedule_td"] is None and SCHEDULE_LABEL in str(
+                string(element)
+            ):
+                anchors["schedule_td"] = element
+        elif tag == "legend":
+            if anchors["records_legend"] is None or anchors["schedule_legend"] is None:
+                text = str(string(element))
+                if anchors["records_legend"] is None and RECORDS_LEGEND in text:
+                    anchors["records_legend"] = element
+                if anchors["schedule_legend"] is None and SCHEDULE_LABEL in text:
+                    anchors["schedule_legend"] = element
+        elif tag == "div":
+            div_id = element.get("id")
+            if (
+                div_id in ("facility_div", "head_coaches_div")
+                and anchors[div_id] is None
+            ):
+                anchors[div_id] = element
+        elif tag == "fieldset":
+            if anchors["fieldset"] is None:
+                anchors["fieldset"] = element
+        elif (
+            anchors["mytable"] is None and "mytable" in element.get("class", "").split()
+        ):
+            anchors["mytable"] = element
+    anchors["links"] = links
+    return anchors
+
+
+# Parse a whole team page with one traversal to find where each table starts,
+# then run every extractor from its anchor. Returns a TeamPage holding the
+# same rows the seven parse_* functions give, as named records. The tree walk
+# and each extractor are timed under parse_stage_seconds.
+def parse_team_page(html, school_id, team_id):
+    try:
+        with metrics.timer("parse_stage_seconds", backend="lxml", stage="tree"):
+            anchors = find_anchors(parse_html(html))
+    except Exception as e:
+        # Without a tree no table can be parsed
+        metrics.count("parse_errors_total", backend="lxml", stage="tree")
+        fields = TeamPage._fields[:-1]
+        return TeamPage(errors=dict.fromkeys(fields, e), **dict.fromkeys(fields))
+    tables, errors = {}, {}
+    for folder, extract, starts in [
+        ("legends", extract_team_legend, [anchors["fieldset"]]),
+        ("coaches", extract_head_coaches, [anchors["head_coaches_div"]]),
+        ("links", extract_links, [anchors["links"]]),
+        ("records", extract_records, [anchors["records_legend"]]),
+        (
+            "schedules",
+            extract_schedule,
+            [anchors["schedule_legend"], anchors["schedule_td"]],
+        ),
+        ("team_page_stats", extract_team_stats, [anchors["mytable"]]),
+        ("venues", extract_venues, [anchors["facility_div"]]),
+    ]:
+        try:
+            with metrics.timer("parse_stage_seconds", backend="lxml", stage=folder):
+                tables[folder] = extract(*starts, school_id, team_id)
+        except Exception as e:
+            tables[folder] = None
+            errors[folder] = e
+            metrics.count("parse_errors_total", backend="lxml", stage=folder)
+    return TeamPage(errors=errors, **tables)
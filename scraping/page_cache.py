@@ -0,0 +1,148 @@
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import time
+
+from common import season_of_year
+
+
+# Whether a season such as "2023-24" is over. Spring seasons end by the
+# summer of their second year, after which the team page no longer changes.
+def season_complete(year, today=None):
+    today = today or datetime.date.today()
+    return today >= datetime.date(season_of_year(str(year)), 7, 1)
+
+
+# Raw HTML cache on disk, addressed by a hash of the URL. Each page is
+# stored gzipped next to a JSON record of its URL, fetch time, validators
+# (ETag / Last-Modified) and whether it is immutable. Immutable pages (past
+# seasons) are always fresh; other pages are fresh for max_age seconds and
+# can then be revalidated with a conditional request.
+class PageCache:
+    def __init__(self, directory, max_age=None):
+        self.directory = directory
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(url):
+        url = url.split("://", 1)[-1].rstrip("/")
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def __path__(self, url, suffix):
+        key = self.key(url)
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def __contains__(self, url):
+        return os.path.exists(self.__path__(url, ".json"))
+
+    def meta(self, url):
+        try:
+            with open(self.__path__(url, ".json")) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def get(self, url):
+        try:
+            with gzip.open(self.__path__(url, ".html.gz"), "rt") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, url, html, etag=None, last_modified=None, immutable=False):
+        path = self.__path__(url, ".html.gz")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so a crash never leaves a torn page
+        with gzip.open(path + ".tmp", "wt") as file:
+            file.write(html)
+        os.replace(path + ".tmp", path)
+        self.__write_meta__(
+            url,
+            {
+                "url": url,
+                "fetched": time.time(),
+                "etag": etag,
+                "last_modified": last_modified,
+                "immutable": immutable,
+                "size": os.path.getsize(path),
+            },
+        )
+
+    # Record that a conditional request came back 304 Not Modified
+    def touch(self, url, immutable=False):
+        meta = self.meta(url)
+        meta["fetched"] = time.time()
+        meta["immutable"] = meta["immutable"] or immutable
+        self.__write_meta__(url, meta)
+
+    def __write_meta__(self, url, meta):
+        path = self.__path__(url, ".json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(meta, file)
+        os.replace(path + ".tmp", path)
+
+    def is_fresh(self, url):
+        meta = self.meta(url)
+        if meta is None:
+            return False
+        if meta["immutable"] or self.max_age is None:
+            return True
+        return time.time() - meta["fetched"] < self.max_age
+
+    # Headers for revalidating a stale page instead of downloading it again
+    def conditional_headers(self, url):
+        meta = self.meta(url) or {}
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def remove(self, url):
+        for suffix in (".html.gz", ".json"):
+            try:
+                os.remove(self.__path__(url, suffix))
+            except FileNotFoundError:
+                pass
+
+    def entries(self):
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if file.endswith(".json"):
+                    with open(os.path.join(root, file)) as f:
+                        yield json.load(f)
+
+    def size(self):
+        return sum(meta["size"] for meta in self.entries())
+
+    # Drop pages fetched more than max_age seconds ago, then the oldest pages
+    # until the cache fits in max_bytes. Immutable pages are only dropped by
+    # size and only after every mutable page has gone.
+    def evict(self, max_bytes=None, max_age=None):
+        entries = list(self.entries())
+        now = time.time()
+        keep = []
+        for meta in entries:
+            if (
+                max_age is not None
+                and not meta["immutable"]
+                and now - meta["fetched"] > max_age
+            ):
+                self.remove(meta["url"])
+            else:
+                keep.append(meta)
+        removed = len(entries) - len(keep)
+        if max_bytes is not None:
+            keep.sort(key=lambda meta: (meta["immutable"], meta["fetched"]))
+            total = sum(meta["size"] for meta in keep)
+            for meta in keep:
+                if total <= max_bytes:
+                    break
+                self.remove(meta["url"])
+                total -= meta["size"]
+                removed += 1
+        return removed
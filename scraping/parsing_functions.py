@@ -1,3 +1,6 @@
+import re
+
+
 # Parse the title row at the top of the page
 def parse_team_legend(soup, school_id, team_id):
     legend = soup.fieldset.legend
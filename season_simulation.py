@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+
+from ELO import site_sign
+
+
+# Order in which seeds are placed in a single elimination bracket so that the
+# top seeds can only meet late, e.g. for 8 teams 1v8, 4v5, 2v7, 3v6
+def bracket_order(n_slots):
+    order = [0]
+    while len(order) < n_slots:
+        size = 2 * len(order)
+        order = [slot for seed in order for slot in (seed, size - 1 - seed)]
+    return order
+
+
+# Play one game in each of the given simulations at once. home, away and sims
+# are matching arrays of team indices into ratings (teams x sims) and of
+# simulation columns; ratings are updated in place.
+def play_games(ratings, home, away, sims, sign, k, elo_diff, home_advantage, rng):
+    home_elo, away_elo = ratings[home, sims], ratings[away, sims]
+    p = 1 / (1 + 10 ** ((away_elo - home_elo - sign * home_advantage) / elo_diff))
+    home_won = rng.random(len(p)) < p
+    if k:
+        delta = k * (home_won - p)
+        ratings[home, sims] = home_elo + delta
+        ratings[away, sims] = away_elo - delta
+    return home_won
+
+
+# Simulate the remaining schedule n_sims times from the current ratings of a
+# fitted ELO, updating ratings after every simulated game. The top
+# playoff_spots teams by wins (ties broken by rating) go to a seeded single
+# elimination tournament on neutral sites. Only teams in the schedule or in
+# teams are simulated, and standings are limited to teams when given, so a
+# conference can be run on its own.
+def simulate_season(
+    elo,
+    home,
+    away,
+    site="home",
+    n_sims=100_000,
+    playoff_spots=4,
+    teams=None,
+    current_wins=None,
+    update_ratings=True,
+    batch_size=10_000,
+    seed=None,
+):
+    rng = np.random.default_rng(seed)
+    home, away = np.asarray(home), np.asarray(away)
+    signs = np.broadcast_to(site_sign(site), home.shape)
+    # teams joins the ids as an array of their own, an empty list would make
+    # integer ids float
+    listed = [home, away] if teams is None else [home, away, np.asarray(teams)]
+    universe = pd.Index(pd.unique(np.concatenate(listed)))
+    standings = universe if teams is None else pd.Index(teams)
+    standing_idx = universe.get_indexer(standings)
+    home_idx, away_idx = universe.get_indexer(home), universe.get_indexer(away)
+    start_ratings = elo.current_ratings(universe)
+    start_wins = np.zeros(len(universe))
+    if current_wins is not None:
+        for team, wins in current_wins.items():
+            if team in universe:
+                start_wins[universe.get_loc(team)] = wins
+
+    assert playoff_spots >= 1
+    k = elo.k if update_ratings else 0
+    slots = bracket_order(1 << (playoff_spots - 1).bit_length())
+    total_wins = np.zeros(len(standings))
+    playoffs = np.zeros(len(standings))
+    championships = np.zeros(len(standings))
+    for start in range(0, n_sims, batch_size):
+        n = min(batch_size, n_sims - start)
+        sims = np.arange(n)
+        ratings = np.repeat(start_ratings[:, None], n, axis=1)
+        wins = np.repeat(start_wins[:, None], n, axis=1)
+        for h, a, sign in zip(home_idx, away_idx, signs):
+            home_won = play_games(
+                ratings, h, a, sims, sign, k, elo.elo_diff, elo.home_advantage, rng
+            )
+            wins[h] += home_won
+            wins[a] += ~home_won
+        total_wins += wins[standing_idx].sum(axis=1)
+
+        # Seed by wins, then rating; seeds holds positions in standings
+        order = np.lexsort((ratings[standing_idx], wins[standing_idx]), axis=0)
+        seeds = order[::-1][:playoff_spots]
+        playoffs += np.bincount(seeds.ravel(), minlength=len(standings))
+
+        # Byes fill the bracket up to a power of two and are marked with -1.
+        # Every team plays at most once per round, so a whole round across all
+        # simulations is a single batched game.
+        bracket = np.full((len(slots), n), -1)
+        bracket[: len(seeds)] = seeds
+        bracket = bracket[slots]
+        while len(bracket) > 1:
+            top, bottom = bracket[0::2], bracket[1::2]
+            played = (top >= 0) & (bottom >= 0)
+            top_won = top >= 0
+            top_won[played] = play_games(
+                ratings,
+                standing_idx[top[played]],
+                standing_idx[bottom[played]],
+                np.broadcast_to(sims, top.shape)[played],
+                0,
+                k,
+                elo.elo_diff,
+                elo.home_advantage,
+                rng,
+            )
+            bracket = np.where(top_won, top, bottom)
+        championships += np.bincount(bracket[0], minlength=len(standings))
+
+    return pd.DataFrame(
+        {
+            "expected_wins": total_wins / n_sims,
+            "playoff_prob": playoffs / n_sims,
+            "championship_prob": championships / n_sims,
+        },
+        index=standings,
+    )